@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Per-operation cost of two-operand `+ - * / =`.
+
+Each operator runs in a loop twice: once through its BINARY_ instruction
+and once with the fast paths turned off, which builds the argument array
+and calls the builtin.
+
+    python bench/bench_arith.py [iterations]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from hoe import compiler
+from hoe.engine import Engine
+from hoe.interpreter import eval_code
+
+SOURCE = """
+x: iter %d
+    y: eval "%s" [x, 7]
+end
+"""
+
+def run(op, iterations, fast):
+    saved = compiler.BINARY_OPS
+    compiler.BINARY_OPS = saved if fast else {}
+    try:
+        code = compiler.compile_source(SOURCE % (iterations, op))
+    finally:
+        compiler.BINARY_OPS = saved
+    start = time.time()
+    eval_code(Engine(sys.argv[0]), code)
+    return (time.time() - start) / iterations
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 100000
+    for op in ['+', '-', '*', '/', '=']:
+        generic = run(op, iterations, False)
+        fast = run(op, iterations, True)
+        print('%s  generic %6.3f us/op  fast %6.3f us/op  %.2fx' % (
+            op, generic * 1e6, fast * 1e6, generic / fast))
+
+if __name__ == '__main__':
+    main(sys.argv)
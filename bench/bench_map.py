@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Per-element cost of `map` and `filter`.
+
+Runs both builtins over arrays whose elements are small and large values.
+The per-element time should stay flat as the elements grow, since
+callbacks receive the evaluated value instead of a re-parsed copy.
+
+    python bench/bench_map.py [count]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from hoe.engine import Engine
+from hoe.interpreter import eval_source_code
+from hoe.runtime import Env, Int, Array
+
+SOURCE = """
+proc "id" value $ end
+proc "keep?" value true end
+mapped: eval "map" ["id", items]
+eval "filter" ["keep?", items]
+"""
+
+def make_items(count, element_size):
+    element = Array([Int(i) for i in range(element_size)])
+    return Array([element for _ in range(count)])
+
+def run(count, element_size):
+    engine = Engine(sys.argv[0])
+    env = Env()
+    env.set('items', make_items(count, element_size))
+    engine.stack.append(env)
+    start = time.time()
+    eval_source_code(engine, SOURCE)
+    elapsed = time.time() - start
+    return elapsed / (2 * count)
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    for element_size in [1, 100, 10000]:
+        per_element = run(count, element_size)
+        print('element size %6d: %8.2f us/element' % (element_size, per_element * 1e6))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Parse throughput, in MB/s, of the hand-written parser and of the
+packrat parser that rpython.rlib.parsing generates from the same EBNF.
+
+    python bench/bench_parse.py [kilobytes]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
+
+from hoe.grammar import EBNF, parse_source
+
+CHUNK = """
+# a comment line
+proc "fib"
+    cond
+        eval "=" [$, 0]
+            value 0
+        value true
+            begin
+                a: eval "-" [$, 1]
+                b: eval "fib" a
+                eval "+" [b, $["k"][0]]
+            end
+    end
+end
+point: value {"x": 1.5, "y": -2e3, "tags": ["a", "b", null, false]}
+i: iter [1, 2, 3]
+    eval "io.puts" [point, i]
+end
+"""
+
+def make_source(kilobytes):
+    return CHUNK * (kilobytes * 1024 // len(CHUNK) + 1)
+
+def ebnf_parser():
+    regexes, rules, to_ast = parse_ebnf(EBNF)
+    parse = make_parse_function(regexes, rules, eof=True)
+    transformer = to_ast()
+    def parse_ebnf_source(source):
+        lines = [l for l in source.splitlines() if not l.strip().startswith('#')]
+        return transformer.transform(parse('\n'.join(lines)))
+    return parse_ebnf_source
+
+def throughput(parse, source, runs=3):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        parse(source)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(source) / best / 1e6
+
+def main(argv):
+    kilobytes = int(argv[1]) if len(argv) > 1 else 64
+    # the packrat parser recurses once per statement
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), kilobytes * 100))
+    source = make_source(kilobytes)
+    start = time.time()
+    reference = ebnf_parser()
+    print('building the EBNF parser: %.3f s' % (time.time() - start))
+    new = throughput(parse_source, source)
+    old = throughput(reference, source)
+    print('%d KB  ebnf %.3f MB/s  hand-written %.3f MB/s  %.1fx' % (
+        len(source) // 1024, old, new, new / old))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Run the benchmark suite and compare it with a baseline.
+
+Every bench/*.ho script reads its problem size from the label `n`, which
+the runner defines in a line put in front of the script. Each script runs
+in a fresh process, once to warm up the caches and then `--runs` times,
+and the runner reports the median and spread of the wall time.
+
+The translated `hoe` binary and the untranslated interpreter, on top of
+a python with rpython installed, run each script at sizes of their own.
+
+    python bench/run.py [options] [name ...]
+
+    --hoe PATH        translated binary (default: henv/bin/hoe or ./hoe)
+    --untranslated    also run src/targethoe.py
+    --python PATH     python for the untranslated interpreter
+    --runs N          timed runs per script (default: 5)
+    --baseline FILE   compare with FILE (default: bench/baseline.json)
+    --threshold X     slowdown of the median counted as a regression
+                      (default: 0.10, i.e. 10%)
+    --save FILE       store the results as a baseline
+
+Exits with 1 if any script fails or regressed against the baseline.
+"""
+
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+
+# name: (n for the translated binary, n for the untranslated interpreter)
+BENCHMARKS = [
+    ('startup', 0, 0),
+    ('fib', 27, 15),
+    ('loop', 3000000, 30000),
+    ('strings', 200000, 10000),
+    ('map_filter', 500000, 10000),
+    ('objects', 2000000, 20000),
+    ('import', 0, 0),
+    ('parse', 14, 9),
+]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def stdev(values):
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+def default_hoe():
+    for path in [os.path.join(ROOT, 'henv', 'bin', 'hoe'),
+                 os.path.join(ROOT, 'hoe')]:
+        if os.path.exists(path):
+            return path
+    return None
+
+def write_script(tmpdir, name, n):
+    with open(os.path.join(BENCH, '%s.ho' % name)) as f:
+        source = f.read()
+    path = os.path.join(tmpdir, '%s.ho' % name)
+    with open(path, 'w') as f:
+        f.write('n: value %d\n' % n)
+        f.write(source)
+    return path
+
+def time_script(command, path, runs):
+    """Return the wall times of `runs` runs after a warm-up run, or None
+    if the script failed."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs + 1):
+            start = time.time()
+            status = subprocess.call(command + [path], stdout=devnull)
+            elapsed = time.time() - start
+            if status != 0:
+                return None
+            if i > 0:
+                times.append(elapsed)
+    return times
+
+def run_target(target, command, size_index, names, runs, tmpdir):
+    results = {}
+    for benchmark in BENCHMARKS:
+        name, n = benchmark[0], benchmark[size_index]
+        if names and name not in names:
+            continue
+        path = write_script(tmpdir, name, n)
+        times = time_script(command, path, runs)
+        if times is None:
+            print('%-13s %-11s FAILED' % (target, name))
+            results[name] = None
+            continue
+        results[name] = {'n': n, 'median': median(times),
+                         'stdev': stdev(times), 'runs': times}
+        print(format_result(target, name, results[name]))
+        sys.stdout.flush()
+    return results
+
+def format_result(target, name, result):
+    cv = result['stdev'] / result['median'] * 100 if result['median'] else 0.0
+    return '%-13s %-11s n=%-8d median %8.3fs  stdev %7.3fs  cv %5.1f%%' % (
+        target, name, result['n'], result['median'], result['stdev'], cv)
+
+def compare(results, baseline, threshold):
+    """Print how every median moved against the baseline and return the
+    number of regressions."""
+    regressions = 0
+    for target in sorted(results):
+        for name, result in sorted(results[target].items()):
+            base = baseline.get(target, {}).get(name)
+            if result is None or base is None or base['n'] != result['n']:
+                continue
+            change = result['median'] / base['median'] - 1
+            verdict = 'ok'
+            if change > threshold:
+                verdict = 'REGRESSION'
+                regressions += 1
+            elif change < -threshold:
+                verdict = 'faster'
+            print('%-13s %-11s %8.3fs -> %8.3fs  %+6.1f%%  %s' % (
+                target, name, base['median'], result['median'],
+                change * 100, verdict))
+    return regressions
+
+def parse_args(argv):
+    options = {'hoe': default_hoe(), 'untranslated': False,
+               'python': sys.executable, 'runs': 5,
+               'baseline': os.path.join(BENCH, 'baseline.json'),
+               'threshold': 0.10, 'save': None, 'names': []}
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--untranslated':
+            options['untranslated'] = True
+        elif arg in ('--hoe', '--python', '--baseline', '--save'):
+            i += 1
+            options[arg[2:]] = argv[i]
+        elif arg == '--runs':
+            i += 1
+            options['runs'] = int(argv[i])
+        elif arg == '--threshold':
+            i += 1
+            options['threshold'] = float(argv[i])
+        elif arg.startswith('--'):
+            raise SystemExit(__doc__)
+        else:
+            options['names'].append(arg)
+        i += 1
+    return options
+
+def main(argv):
+    options = parse_args(argv)
+    targets = []
+    if options['hoe'] is not None:
+        targets.append(('translated', [os.path.abspath(options['hoe'])], 1))
+    if options['untranslated']:
+        targets.append(('untranslated', [
+            options['python'], os.path.join(ROOT, 'src', 'targethoe.py')], 2))
+    if not targets:
+        raise SystemExit('no hoe binary found; pass --hoe or --untranslated.')
+    tmpdir = tempfile.mkdtemp(prefix='hoe-bench-')
+    results = {}
+    failed = False
+    for target, command, size_index in targets:
+        results[target] = run_target(target, command, size_index,
+                                     options['names'], options['runs'],
+                                     tmpdir)
+        failed = failed or None in results[target].values()
+    regressions = 0
+    if os.path.exists(options['baseline']):
+        with open(options['baseline']) as f:
+            baseline = json.load(f)
+        print('')
+        print('against %s (threshold %.0f%%):' % (
+            options['baseline'], options['threshold'] * 100))
+        regressions = compare(results, baseline, options['threshold'])
+    if options['save']:
+        with open(options['save'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if failed or regressions:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
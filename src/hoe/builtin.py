@@ -1,9 +1,13 @@
 
+from rpython.rlib import jit
 from rpython.rlib.rpath import rabspath, rjoin
 from hoe.runtime import (Env, Type, Int, Float,
                          Str, Bool, Null, Array,
-                         Object,
-                         null, true, false)
+                         Object, Seq, Cursor, Range,
+                         null, true, false, newint, concat)
+from hoe.memo import Memo, DEFAULT_LIMIT
+from hoe.fileio import File
+from hoe.scheduler import Task, Channel
 from hoe.lib import socket
 
 def builtin_type(engine, payload):
@@ -21,24 +25,47 @@ def builtin_type(engine, payload):
         return Str('array')
     elif isinstance(payload, Object):
         return Str('object')
+    elif isinstance(payload, File):
+        return Str('file')
+    elif isinstance(payload, socket.Socket):
+        return Str('socket')
+    elif isinstance(payload, Task):
+        return Str('task')
+    elif isinstance(payload, Channel):
+        return Str('channel')
+    elif isinstance(payload, Seq):
+        return Str('seq')
     else:
         raise Exception('unknown data type.')
 
 def builtin_plus(engine, payload):
     if not isinstance(payload, Array):
         raise Exception('unknown data type')
-    if isinstance(payload.array_val[0], Float) or isinstance(payload.array_val[0], Int):
+    if isinstance(payload.getitem(0), Float) or isinstance(payload.getitem(0), Int):
         return builtin_plus_number(engine, payload)
-    elif isinstance(payload.array_val[0], Str):
+    elif isinstance(payload.getitem(0), Str):
         return builtin_plus_string(engine, payload)
     else:
         raise Exception('unknown element type')
 
 def builtin_plus_number(engine, payload):
+    ints = payload.int_storage()
+    if ints is not None:
+        i = 0
+        for int_val in ints:
+            i += int_val
+        return newint(i)
+    floats = payload.float_storage()
+    if floats is not None:
+        f = 0.0
+        for float_val in floats:
+            f += float_val
+        return Float(f)
     i = 0
     f = 0.0
     has_float = False
-    for el in payload.array_val:
+    for index in range(payload.length()):
+        el = payload.getitem(index)
         if isinstance(el, Float):
             has_float = True
             f += el.float_val
@@ -49,24 +76,43 @@ def builtin_plus_number(engine, payload):
     if has_float:
         return Float(f + i)
     else:
-        return Int(i)
+        return newint(i)
+
+def builtin_plus_atom(left, right):
+    if isinstance(left, Int) and isinstance(right, Int):
+        return newint(left.int_val + right.int_val)
+    elif isinstance(left, Int) and isinstance(right, Float):
+        return Float(right.float_val + left.int_val)
+    elif isinstance(left, Float) and isinstance(right, Float):
+        return Float(left.float_val + right.float_val)
+    elif isinstance(left, Float) and isinstance(right, Int):
+        return Float(left.float_val + right.int_val)
+    elif isinstance(left, Str) and isinstance(right, Str):
+        return concat(left, right)
+    else:
+        raise Exception('unknown element type')
 
 def builtin_plus_string(engine, payload):
-    str_array = [x.str_val for x in payload.array_val]
-    return Str(''.join(str_array))
+    result = Str('')
+    for i in range(payload.length()):
+        el = payload.getitem(i)
+        if not isinstance(el, Str):
+            raise Exception('unknown element type')
+        result = concat(result, el)
+    return result
 
 def builtin_minus(engine, payload):
     if not isinstance(payload, Array):
         raise Exception('unknown parameter')
-    if len(payload.array_val) == 0:
-        return Int(0)
-    elif len(payload.array_val) == 1:
-        return payload.array_val[0]
+    if payload.length() == 0:
+        return newint(0)
+    elif payload.length() == 1:
+        return payload.getitem(0)
     else:
         i = 1
-        val = Int(0)
-        while i < len(payload.array_val):
-            val = builtin_minus_atom(payload.array_val[i-1], payload.array_val[i])
+        val = newint(0)
+        while i < payload.length():
+            val = builtin_minus_atom(payload.getitem(i-1), payload.getitem(i))
             i += 1
         return val
 
@@ -78,22 +124,22 @@ def builtin_minus_atom(left, right):
     elif isinstance(left, Float) and isinstance(right, Int):
         return Float(left.float_val - right.int_val)
     elif isinstance(left, Int) and isinstance(right, Int):
-        return Int(left.int_val - right.int_val)
+        return newint(left.int_val - right.int_val)
     else:
         raise Exception('unknown data type')
 
 def builtin_mul(engine, payload):
     if not isinstance(payload, Array):
         raise Exception('unknown parameter')
-    if len(payload.array_val) == 0:
-        return Int(1)
-    elif len(payload.array_val) == 1:
-        return payload.array_val[0]
+    if payload.length() == 0:
+        return newint(1)
+    elif payload.length() == 1:
+        return payload.getitem(0)
     else:
         i = 1
-        val = Int(1)
-        while i < len(payload.array_val):
-            val = builtin_mul_atom(payload.array_val[i-1], payload.array_val[i])
+        val = newint(1)
+        while i < payload.length():
+            val = builtin_mul_atom(payload.getitem(i-1), payload.getitem(i))
             i += 1
         return val
 
@@ -105,22 +151,22 @@ def builtin_mul_atom(left, right):
     elif isinstance(left, Float) and isinstance(right, Int):
         return Float(left.float_val * right.int_val)
     elif isinstance(left, Int) and isinstance(right, Int):
-        return Int(left.int_val * right.int_val)
+        return newint(left.int_val * right.int_val)
     else:
         raise Exception('unknown data type')
 
 def builtin_div(engine, payload):
     if not isinstance(payload, Array):
         raise Exception('unknown parameter')
-    if len(payload.array_val) == 0:
-        return Int(1)
-    elif len(payload.array_val) == 1:
-        return payload.array_val[0]
+    if payload.length() == 0:
+        return newint(1)
+    elif payload.length() == 1:
+        return payload.getitem(0)
     else:
         i = 1
-        val = Int(1)
-        while i < len(payload.array_val):
-            val = builtin_div_atom(payload.array_val[i-1], payload.array_val[i])
+        val = newint(1)
+        while i < payload.length():
+            val = builtin_div_atom(payload.getitem(i-1), payload.getitem(i))
             i += 1
         return val
 
@@ -137,7 +183,7 @@ def builtin_div_atom(left, right):
     elif isinstance(left, Float) and isinstance(right, Int):
         return Float(left.float_val / right.int_val)
     elif isinstance(left, Int) and isinstance(right, Int):
-        return Int(left.int_val / right.int_val)
+        return newint(left.int_val / right.int_val)
     else:
         raise Exception('unknown data type')
 
@@ -147,17 +193,11 @@ def builtin_eq(engine, payload):
     if not isinstance(payload, Array):
         raise Exception('unknown parameter')
     prev = None
-    for el in payload.array_val:
+    for i in range(payload.length()):
+        el = payload.getitem(i)
         if prev is not None:
             if isinstance(prev, Array) and isinstance(el, Array):
-                if len(prev.array_val) != len(el.array_val):
-                    return false
-                for i in range(len(el.array_val)):
-                    left = prev.array_val[i]
-                    right = el.array_val[i]
-                    if not builtin_eq_atom(left, right).bool_val:
-                        return false
-                return true
+                return builtin_eq_pair(prev, el)
             else:
                 # XXX: Support object eq comparison.
                 if not builtin_eq_atom(prev, el).bool_val:
@@ -165,6 +205,16 @@ def builtin_eq(engine, payload):
         prev = el
     return true
 
+def builtin_eq_pair(left, right):
+    if isinstance(left, Array) and isinstance(right, Array):
+        if left.length() != right.length():
+            return false
+        for i in range(left.length()):
+            if not builtin_eq_atom(left.getitem(i), right.getitem(i)).bool_val:
+                return false
+        return true
+    return builtin_eq_atom(left, right)
+
 def builtin_eq_atom(left, right):
     if isinstance(left, Int) and isinstance(right, Int) and left.int_val == right.int_val:
         return true
@@ -174,7 +224,7 @@ def builtin_eq_atom(left, right):
         return true
     elif isinstance(left, Float) and isinstance(right, Float) and left.float_val == right.float_val:
         return true
-    elif isinstance(left, Str) and isinstance(right, Str) and left.str_val == right.str_val:
+    elif isinstance(left, Str) and isinstance(right, Str) and left.size == right.size and left.str_val == right.str_val:
         return true
     elif isinstance(left, Null) and isinstance(right, Null):
         return true
@@ -184,32 +234,101 @@ def builtin_eq_atom(left, right):
         return false
 
 def builtin_io_puts(engine, payload):
-    print payload.__str__()
+    payload.dump(engine.stdout)
+    engine.stdout.write('\n')
+    return null
+
+def builtin_io_flush(engine, payload):
+    if isinstance(payload, File):
+        payload.flush()
+    elif isinstance(payload, Null):
+        engine.stdout.flush()
+    else:
+        raise Exception('unknown data type.')
+    return null
+
+def builtin_io_open(engine, payload):
+    if isinstance(payload, Str):
+        return engine.open_file(payload.str_val, 'r')
+    if not isinstance(payload, Array) or payload.length() != 2:
+        raise Exception('unknown data type.')
+    path = payload.getitem(0)
+    mode = payload.getitem(1)
+    if not isinstance(path, Str) or not isinstance(mode, Str):
+        raise Exception('unknown data type.')
+    return engine.open_file(path.str_val, mode.str_val)
+
+def builtin_io_read(engine, payload):
+    if isinstance(payload, File):
+        return Str(payload.read(-1))
+    if not isinstance(payload, Array) or payload.length() != 2:
+        raise Exception('unknown data type.')
+    file = payload.getitem(0)
+    size = payload.getitem(1)
+    if not isinstance(file, File) or not isinstance(size, Int):
+        raise Exception('unknown data type.')
+    return Str(file.read(size.int_val))
+
+def builtin_io_readline(engine, payload):
+    if not isinstance(payload, File):
+        raise Exception('unknown data type.')
+    return Str(payload.readline())
+
+def builtin_io_write(engine, payload):
+    if not isinstance(payload, Array) or payload.length() != 2:
+        raise Exception('unknown data type.')
+    file = payload.getitem(0)
+    data = payload.getitem(1)
+    if not isinstance(file, File) or not isinstance(data, Str):
+        raise Exception('unknown data type.')
+    return newint(file.write(data.str_val))
+
+def builtin_io_close(engine, payload):
+    if not isinstance(payload, File):
+        raise Exception('unknown data type.')
+    payload.close()
+    return null
 
 def builtin_str(engine, payload):
     return Str(payload.__str__())
 
 def builtin_abs(engine, payload):
     if isinstance(payload, Int):
-        return Int(0-payload.int_val)
+        return newint(0-payload.int_val)
     elif isinstance(payload, Float):
         return Float(0-payload.float_val)
     else:
         raise Exception('unknown data type.')
 
 def builtin_all(engine, payload):
+    if isinstance(payload, Seq):
+        cursor = payload.cursor()
+        el = cursor.next()
+        while el is not None:
+            if not builtin_bool(engine, el).bool_val:
+                return false
+            el = cursor.next()
+        return true
     if not isinstance(payload, Array):
         raise Exception('unknown data type.')
-    for el in payload.array_val:
-        if not builtin_bool(engine, el).bool_val:
+    for i in range(payload.length()):
+        if not builtin_bool(engine, payload.getitem(i)).bool_val:
             return false
     return true
 
 def builtin_any(engine, payload):
+    if isinstance(payload, Seq):
+        cursor = payload.cursor()
+        el = cursor.next()
+        while el is not None:
+            if builtin_bool(engine, el).bool_val:
+                return true
+            el = cursor.next()
+        return false
     if not isinstance(payload, Array):
         raise Exception('unknown data type.')
-    for el in payload.array_val:
-        if builtin_bool(engine, el).bool_val:
+    for i in range(payload.length()):
+        if builtin_bool(engine, payload.getitem(i)).bool_val:
             return true
     return false
 
@@ -242,73 +361,197 @@ def _dirname(path):
 def builtin_import(engine, payload):
     if not isinstance(payload, Str):
         raise Exception('unknown data type.')
-    stack = engine.current_stack()
     executable_path = rabspath(engine.executable)
     pkg = rjoin(_dirname(_dirname(executable_path)), 'pkg')
     path = rjoin(pkg, '%s.ho' % payload.str_val)
-    with open(path) as f:
-        env = engine.run_module_code(f.read())
-        stack = engine.current_stack()
-        stack.namespace.update(env.namespace)
-        stack.defs.update(env.defs)
+    env = engine.import_module(path)
+    stack = engine.current_stack()
+    for key, value in env.items():
+        stack.set(key, value)
+    stack.defs.update(env.defs)
+    engine.invalidate_procs()
     return null
 
+def builtin_import_stats(engine, payload):
+    return Object({
+        'modules': newint(len(engine.modules)),
+        'hits': newint(engine.module_hits),
+        'misses': newint(engine.module_misses),
+    })
+
+def builtin_proc_stats(engine, payload):
+    return Object({
+        'version': newint(engine.proc_version),
+        'hits': newint(engine.proc_cache_hits),
+        'misses': newint(engine.proc_cache_misses),
+    })
+
 def builtin_cmp(engine, payload):
     if isinstance(payload, Array):
         raise Exception('unknown data type.')
 
 def builtin_len(engine, payload):
     if isinstance(payload, Str):
-        return Int(len(payload.str_val))
+        return newint(payload.length())
     elif isinstance(payload, Array):
-        return Int(len(payload.array_val))
+        return newint(payload.length())
     elif isinstance(payload, Object):
-        return Int(len(payload.object_val))
+        return newint(payload.length())
+    elif isinstance(payload, Seq):
+        return newint(payload.length())
     else:
         raise Exception('unknown data type.')
 
+def builtin_range(engine, payload):
+    if isinstance(payload, Int):
+        return Range(0, payload.int_val, 1)
+    if not isinstance(payload, Array):
+        raise Exception('unknown data type.')
+    if payload.length() != 2 and payload.length() != 3:
+        raise Exception('unknown data type.')
+    bounds = []
+    for i in range(payload.length()):
+        el = payload.getitem(i)
+        if not isinstance(el, Int):
+            raise Exception('unknown data type.')
+        bounds.append(el.int_val)
+    step = bounds[2] if len(bounds) == 3 else 1
+    return Range(bounds[0], bounds[1], step)
+
+class Callback(object):
+    """The proc or builtin a lazy `map` or `filter` calls, looked up where
+    the seq is made, since it may be read outside the proc defining it."""
+    def __init__(self, engine, func_name):
+        self.engine = engine
+        self.func_name = func_name
+        self.proc = None
+        if not is_builtin(func_name):
+            self.proc = engine.lookup_proc(func_name)
+    def call(self, payload):
+        if self.proc is None:
+            return self.engine.call(self.func_name, payload)
+        return self.engine.call_proc(self.proc, payload)
+
+class MapSeq(Seq):
+    """`map` over a lazy sequence, calling the proc as elements are read."""
+    def __init__(self, callback, source):
+        self.callback = callback
+        self.source = source
+    def cursor(self):
+        return MapCursor(self.callback, self.source.cursor())
+    def length(self):
+        return self.source.length()
+
+class MapCursor(Cursor):
+    def __init__(self, callback, source):
+        self.callback = callback
+        self.source = source
+    def next(self):
+        el = self.source.next()
+        if el is None:
+            return None
+        return self.callback.call(el)
+
+class FilterSeq(Seq):
+    """`filter` over a lazy sequence."""
+    def __init__(self, callback, source):
+        self.callback = callback
+        self.source = source
+    def cursor(self):
+        return FilterCursor(self.callback, self.source.cursor())
+
+class FilterCursor(Cursor):
+    def __init__(self, callback, source):
+        self.callback = callback
+        self.source = source
+    def next(self):
+        el = self.source.next()
+        engine = self.callback.engine
+        while el is not None:
+            if builtin_bool(engine, self.callback.call(el)).bool_val:
+                return el
+            el = self.source.next()
+        return None
+
 def builtin_map(engine, payload):
     if not isinstance(payload, Array):
         raise Exception('unknown data type.')
-    if len(payload.array_val) != 2:
+    if payload.length() != 2:
         raise Exception('unknown data type.')
-    func_name = payload.array_val[0]
-    iterable = payload.array_val[1]
+    func_name = payload.getitem(0)
+    iterable = payload.getitem(1)
     if not isinstance(func_name, Str):
         raise Exception('unknown data type.')
+    if isinstance(iterable, Seq):
+        return MapSeq(Callback(engine, func_name.str_val), iterable)
     if not isinstance(iterable, Array):
         raise Exception('unknown data type.')
-    new_array_val = []
-    for el in iterable.array_val:
-        engine.stack.append(Env())
-        macro = """
-            eval %s %s
-        """ % (func_name.__str__(), el.__str__())
-        new_val = engine.run_macro_code(macro)
-        new_array_val.append(new_val)
-    return Array(new_array_val)
+    new_array = Array([])
+    for i in range(iterable.length()):
+        new_array.append(engine.call(func_name.str_val, iterable.getitem(i)))
+    return new_array
 
 def builtin_filter(engine, payload):
     if not isinstance(payload, Array):
         raise Exception('unknown data type.')
-    if len(payload.array_val) != 2:
+    if payload.length() != 2:
         raise Exception('unknown data type.')
-    func_name = payload.array_val[0]
-    iterable = payload.array_val[1]
+    func_name = payload.getitem(0)
+    iterable = payload.getitem(1)
     if not isinstance(func_name, Str):
         raise Exception('unknown data type.')
+    if isinstance(iterable, Seq):
+        return FilterSeq(Callback(engine, func_name.str_val), iterable)
     if not isinstance(iterable, Array):
         raise Exception('unknown data type.')
-    new_array_val = []
-    for el in iterable.array_val:
-        engine.stack.append(Env())
-        macro = """
-            eval %s %s
-        """ % (func_name.__str__(), el.__str__())
-        new_val = engine.run_macro_code(macro)
+    new_array = Array([])
+    for i in range(iterable.length()):
+        el = iterable.getitem(i)
+        new_val = engine.call(func_name.str_val, el)
         if builtin_bool(engine, new_val).bool_val:
-            new_array_val.append(el)
-    return Array(new_array_val)
+            new_array.append(el)
+    return new_array
+
+def builtin_pmap(engine, payload):
+    if not isinstance(payload, Array):
+        raise Exception('unknown data type.')
+    if payload.length() != 2 and payload.length() != 3:
+        raise Exception('unknown data type.')
+    func_name = payload.getitem(0)
+    iterable = payload.getitem(1)
+    if not isinstance(func_name, Str):
+        raise Exception('unknown data type.')
+    if payload.length() == 3:
+        workers = payload.getitem(2)
+        if not isinstance(workers, Int):
+            raise Exception('unknown data type.')
+        count = workers.int_val
+    else:
+        count = 0
+    if isinstance(iterable, Array):
+        items = iterable.array_val
+    elif isinstance(iterable, Seq):
+        items = seq_items(iterable)
+    else:
+        raise Exception('unknown data type.')
+    return Array(engine.pmap(func_name.str_val, items, count))
+
+def seq_items(seq):
+    items = []
+    cursor = seq.cursor()
+    el = cursor.next()
+    while el is not None:
+        items.append(el)
+        el = cursor.next()
+    return items
+
+def builtin_array(engine, payload):
+    """Read a lazy sequence into an array."""
+    if isinstance(payload, Array):
+        return payload
+    if not isinstance(payload, Seq):
+        raise Exception('unknown data type.')
+    return Array(seq_items(payload))
 
 def builtin_eval(engine, payload):
     if not isinstance(payload, Str):
@@ -316,9 +559,185 @@ def builtin_eval(engine, payload):
     engine.stack.append(Env())
     return engine.run_macro_code(payload.str_val)
 
+def builtin_pure(engine, payload):
+    if isinstance(payload, Str):
+        func_name = payload
+        limit = newint(DEFAULT_LIMIT)
+    elif isinstance(payload, Array) and payload.length() == 2:
+        func_name = payload.getitem(0)
+        limit = payload.getitem(1)
+    else:
+        raise Exception('unknown data type.')
+    if not isinstance(func_name, Str) or not isinstance(limit, Int):
+        raise Exception('unknown data type.')
+    if limit.int_val < 1:
+        raise Exception('invalid cache size.')
+    proc = engine.lookup_proc(func_name.str_val)
+    proc.memo = Memo(limit.int_val)
+    return null
+
+def builtin_pure_stats(engine, payload):
+    if not isinstance(payload, Str):
+        raise Exception('unknown data type.')
+    memo = engine.lookup_proc(payload.str_val).memo
+    if memo is None:
+        raise Exception('not a pure proc: %s' % payload.str_val)
+    return Object({
+        'hits': newint(memo.hits),
+        'misses': newint(memo.misses),
+        'evictions': newint(memo.evictions),
+        'size': newint(memo.size()),
+        'limit': newint(memo.limit),
+    })
+
 def builtin_socket_gethostname(engine, payload):
     return socket.hoe_gethostname()
 
+def _host_and_port(payload):
+    if not isinstance(payload, Array) or payload.length() != 2:
+        raise Exception('unknown data type.')
+    host = payload.getitem(0)
+    port = payload.getitem(1)
+    if not isinstance(host, Str) or not isinstance(port, Int):
+        raise Exception('unknown data type.')
+    return host.str_val, port.int_val
+
+def _socket_and_arg(payload):
+    if not isinstance(payload, Array) or payload.length() != 2:
+        raise Exception('unknown data type.')
+    sock = payload.getitem(0)
+    if not isinstance(sock, socket.Socket):
+        raise Exception('unknown data type.')
+    return sock, payload.getitem(1)
+
+def builtin_socket_listen(engine, payload):
+    host, port = _host_and_port(payload)
+    return socket.listen(host, port, 1024)
+
+def builtin_socket_connect(engine, payload):
+    host, port = _host_and_port(payload)
+    return socket.connect(host, port)
+
+def builtin_socket_port(engine, payload):
+    if not isinstance(payload, socket.Socket):
+        raise Exception('unknown data type.')
+    return newint(payload.port())
+
+def builtin_socket_setblocking(engine, payload):
+    sock, blocking = _socket_and_arg(payload)
+    if not isinstance(blocking, Bool):
+        raise Exception('unknown data type.')
+    sock.setblocking(blocking.bool_val)
+    return null
+
+def builtin_socket_accept(engine, payload):
+    if not isinstance(payload, socket.Socket):
+        raise Exception('unknown data type.')
+    conn = payload.accept()
+    return null if conn is None else conn
+
+def builtin_socket_recv(engine, payload):
+    if isinstance(payload, socket.Socket):
+        sock = payload
+        size = socket.RECV_SIZE
+    else:
+        sock, size_val = _socket_and_arg(payload)
+        if not isinstance(size_val, Int):
+            raise Exception('unknown data type.')
+        size = size_val.int_val
+    data = sock.recv(size)
+    return null if data is None else Str(data)
+
+def builtin_socket_send(engine, payload):
+    sock, data = _socket_and_arg(payload)
+    if not isinstance(data, Str):
+        raise Exception('unknown data type.')
+    return newint(sock.send(data.str_val))
+
+def builtin_socket_close(engine, payload):
+    if not isinstance(payload, socket.Socket):
+        raise Exception('unknown data type.')
+    engine.loop.unwatch(payload)
+    payload.close()
+    return null
+
+def builtin_socket_watch(engine, payload):
+    if not isinstance(payload, Array) or payload.length() != 3:
+        raise Exception('unknown data type.')
+    sock = payload.getitem(0)
+    mode = payload.getitem(1)
+    func_name = payload.getitem(2)
+    if (not isinstance(sock, socket.Socket) or not isinstance(mode, Str)
+            or not isinstance(func_name, Str)):
+        raise Exception('unknown data type.')
+    engine.loop.watch(sock, mode.str_val, func_name.str_val)
+    return null
+
+def builtin_socket_unwatch(engine, payload):
+    if not isinstance(payload, socket.Socket):
+        raise Exception('unknown data type.')
+    engine.loop.unwatch(payload)
+    return null
+
+def builtin_socket_loop(engine, payload):
+    if isinstance(payload, Null):
+        timeout = -1
+    elif isinstance(payload, Int):
+        timeout = payload.int_val
+    else:
+        raise Exception('unknown data type.')
+    return newint(engine.loop.run(engine, timeout))
+
+def builtin_socket_stop(engine, payload):
+    engine.loop.stop()
+    return null
+
+def builtin_task_spawn(engine, payload):
+    if isinstance(payload, Str):
+        return engine.spawn(payload.str_val, null)
+    if not isinstance(payload, Array) or payload.length() != 2:
+        raise Exception('unknown data type.')
+    func_name = payload.getitem(0)
+    if not isinstance(func_name, Str):
+        raise Exception('unknown data type.')
+    return engine.spawn(func_name.str_val, payload.getitem(1))
+
+def builtin_task_yield(engine, payload):
+    engine.scheduler.yield_(engine)
+    return null
+
+def builtin_task_join(engine, payload):
+    if not isinstance(payload, Task):
+        raise Exception('unknown data type.')
+    return engine.scheduler.join(engine, payload)
+
+def builtin_task_run(engine, payload):
+    if engine.scheduler.current is not None:
+        raise Exception('task.run is only allowed outside of tasks.')
+    engine.scheduler.run_all(engine)
+    return null
+
+def builtin_chan_new(engine, payload):
+    if isinstance(payload, Null):
+        return Channel(0)
+    if not isinstance(payload, Int) or payload.int_val < 0:
+        raise Exception('unknown data type.')
+    return Channel(payload.int_val)
+
+def builtin_chan_send(engine, payload):
+    if not isinstance(payload, Array) or payload.length() != 2:
+        raise Exception('unknown data type.')
+    channel = payload.getitem(0)
+    if not isinstance(channel, Channel):
+        raise Exception('unknown data type.')
+    engine.scheduler.send(engine, channel, payload.getitem(1))
+    return null
+
+def builtin_chan_recv(engine, payload):
+    if not isinstance(payload, Channel):
+        raise Exception('unknown data type.')
+    return engine.scheduler.recv(engine, payload)
+
 BUILTINS = {
     '+': builtin_plus,
     '-': builtin_minus,
@@ -328,21 +747,57 @@ BUILTINS = {
     'abs': builtin_abs,
     'all': builtin_all,
     'any': builtin_any,
+    'array': builtin_array,
     'bool': builtin_bool,
+    'chan.new': builtin_chan_new,
+    'chan.recv': builtin_chan_recv,
+    'chan.send': builtin_chan_send,
     'bin': builtin_bin,
     'eval': builtin_eval,
     'filter': builtin_filter,
     'len': builtin_len,
     'map': builtin_map,
     'import': builtin_import,
+    'import.stats': builtin_import_stats,
+    'io.close': builtin_io_close,
+    'io.flush': builtin_io_flush,
+    'io.open': builtin_io_open,
     'io.puts': builtin_io_puts,
+    'io.read': builtin_io_read,
+    'io.readline': builtin_io_readline,
+    'io.write': builtin_io_write,
+    'proc.stats': builtin_proc_stats,
+    'pmap': builtin_pmap,
+    'pure': builtin_pure,
+    'pure.stats': builtin_pure_stats,
+    'range': builtin_range,
     'str': builtin_str,
+    'task.join': builtin_task_join,
+    'task.run': builtin_task_run,
+    'task.spawn': builtin_task_spawn,
+    'task.yield': builtin_task_yield,
+    'socket._accept': builtin_socket_accept,
+    'socket._close': builtin_socket_close,
+    'socket._connect': builtin_socket_connect,
     'socket._gethostname': builtin_socket_gethostname,
+    'socket._listen': builtin_socket_listen,
+    'socket._loop': builtin_socket_loop,
+    'socket._port': builtin_socket_port,
+    'socket._recv': builtin_socket_recv,
+    'socket._send': builtin_socket_send,
+    'socket._setblocking': builtin_socket_setblocking,
+    'socket._stop': builtin_socket_stop,
+    'socket._unwatch': builtin_socket_unwatch,
+    'socket._watch': builtin_socket_watch,
     'type': builtin_type,
 }
 
 def is_builtin(op):
     return op in BUILTINS
 
+@jit.elidable
+def lookup_builtin(op):
+    return BUILTINS[op]
+
 def builtin(engine, op, payload):
-    return BUILTINS[op](engine, payload)
+    return lookup_builtin(op)(engine, payload)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Every instruction is two ints wide: an opcode followed by its argument.
+# Instructions that take no argument are padded with 0.
+#
+# The TAIL_ variants are emitted for the last statement of a proc, and
+# recursively for the last statement of cond branches and begin blocks
+# in that position. They fall back to a plain call when the current env
+# defines procs, because callees may still look those up.
+
+LOAD_CONST = 0      # push consts[arg]
+LOAD_LABEL = 1      # push slot arg of the current env
+LOAD_PAYLOAD = 2    # push the nearest `$`
+GET_INDEX = 3       # pop index, pop value, push value[index]
+                    # using index_caches[arg]
+BUILD_ARRAY = 4     # pop arg values, push an array
+BUILD_OBJECT = 5    # pop arg key/value pairs, push an object
+STORE = 6           # pop a value, bind it to slot arg and `^`
+CALL_BUILTIN = 7    # pop payload, push the result of builtin names[arg]
+CALL_PROC = 8       # pop payload, push the result of proc names[arg]
+                    # using call_caches[arg]
+DEFINE_PROC = 9     # define codes[arg] in the current env, push null
+BEGIN = 10          # run codes[arg] in a new env, push its result
+JUMP = 11           # jump to arg
+JUMP_IF_FALSE = 12  # pop a value, jump to arg if it is falsy
+GET_ITER = 13       # pop a value, start iterating it, binding slot arg
+FOR_ITER = 14       # advance the iterator, or push its result and jump to arg
+TAIL_CALL_PROC = 15 # CALL_PROC in tail position, replacing the current frame
+TAIL_BEGIN = 16     # BEGIN in tail position, replacing the current frame
+BINARY_ADD = 17     # pop right, pop left, push `eval "+" [left, right]`
+BINARY_SUB = 18     # likewise for "-"
+BINARY_MUL = 19     # likewise for "*"
+BINARY_DIV = 20     # likewise for "/"
+BINARY_EQ = 21      # likewise for "="
+END_BODY = 22       # note that the body of an `iter` ran in the frame
+STORE_LOOP = 23     # STORE, but only to `^` if END_BODY ran since the
+                    # statement started, as body statements reset its label
+
+OPNAMES = [
+    'LOAD_CONST', 'LOAD_LABEL', 'LOAD_PAYLOAD', 'GET_INDEX', 'BUILD_ARRAY',
+    'BUILD_OBJECT', 'STORE', 'CALL_BUILTIN', 'CALL_PROC', 'DEFINE_PROC',
+    'BEGIN', 'JUMP', 'JUMP_IF_FALSE', 'GET_ITER', 'FOR_ITER',
+    'TAIL_CALL_PROC', 'TAIL_BEGIN', 'BINARY_ADD', 'BINARY_SUB',
+    'BINARY_MUL', 'BINARY_DIV', 'BINARY_EQ', 'END_BODY', 'STORE_LOOP',
+]
+
+
+class CallCache(object):
+    """Inline cache of a CALL_PROC site.
+
+    `proc` is valid while `version` equals the engine's proc version,
+    which changes whenever the set of visible procs may have changed.
+    The JIT guards on the version rather than folding it.
+    """
+
+    def __init__(self):
+        self.version = -1
+        self.proc = None
+
+
+class FieldCache(object):
+    """Inline cache of a GET_INDEX site: where `key` lives in `shape`."""
+
+    def __init__(self):
+        self.shape = None
+        self.key = ''
+        self.index = -1
+
+
+from hoe.runtime import Scope
+
+
+class Code(object):
+    """Compiled form of a script, module, proc or begin block."""
+
+    _immutable_fields_ = ['name', 'instructions[*]', 'consts[*]',
+                          'names[*]', 'scope', 'codes[*]', 'call_caches[*]',
+                          'index_caches[*]', 'memo?']
+
+    def __init__(self, name, instructions, consts, names, labels, codes):
+        self.name = name
+        self.instructions = instructions
+        self.consts = consts
+        self.names = names
+        self.scope = Scope(labels)
+        self.codes = codes
+        self.call_caches = [CallCache() for name in names]
+        self.index_caches = [FieldCache() for i in range(count_op(
+            instructions, GET_INDEX))]
+        self.memo = None # set by the `pure` builtin
+
+    def dump(self):
+        lines = []
+        pc = 0
+        while pc < len(self.instructions):
+            op = self.instructions[pc]
+            arg = self.instructions[pc + 1]
+            lines.append('%4d %-14s %d' % (pc, OPNAMES[op], arg))
+            pc += 2
+        return '\n'.join(lines)
+
+
+def count_op(instructions, op):
+    count = 0
+    for pc in range(0, len(instructions), 2):
+        if instructions[pc] == op:
+            count += 1
+    return count
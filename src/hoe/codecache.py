@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Compiled modules are cached next to their source as `<name>.hoc`.
+#
+# A cache file records the mtime and md5 of the source it was compiled
+# from. It is only used when both still match, so loading it never needs
+# the parser. Code objects are flattened into a value table and a code
+# table before being marshalled, and children come before their parents.
+# The marshalled data follows its md5, so a damaged file is recompiled
+# before unmarshalling reads a bogus length from it.
+
+import os
+
+from rpython.rlib.rmarshal import get_marshaller, get_unmarshaller
+from rpython.rlib.rmd5 import RMD5
+
+from hoe.bytecode import Code
+from hoe.compiler import compile_source
+from hoe.runtime import (Int, Float, Str, Bool, Null, Array, Object,
+                         null, true, false, newint)
+
+MAGIC = 'hoc'
+VERSION = 6
+CHECKSUM_SIZE = 16
+
+TAG_NULL = 0
+TAG_TRUE = 1
+TAG_FALSE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_ARRAY = 6
+TAG_OBJECT = 7
+
+VALUE = (int, int, float, str, [int])
+CODE = (str, [int], [int], [str], [str], [int])
+CACHE = (str, int, float, str, [VALUE], [CODE])
+
+dump_cache = get_marshaller(CACHE)
+load_cache = get_unmarshaller(CACHE)
+
+
+def cache_path(path):
+    return path + 'c'
+
+def source_digest(source_code):
+    return RMD5(source_code).hexdigest()
+
+def load_module_code(path):
+    """Return the compiled code of the module at `path`.
+
+    The cache is consulted first. On a miss the source is compiled and
+    the cache is rewritten; failing to write it is not an error.
+    """
+    with open(path) as f:
+        source_code = f.read()
+    mtime = os.stat(path).st_mtime
+    digest = source_digest(source_code)
+    code = read_cache(cache_path(path), mtime, digest)
+    if code is None:
+        code = compile_source(source_code, 'module')
+        try:
+            write_cache(cache_path(path), mtime, digest, code)
+        except (IOError, OSError):
+            pass
+    return code
+
+def read_cache(path, mtime, digest):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    try:
+        return loads(data, mtime, digest)
+    except ValueError:
+        return None
+
+def write_cache(path, mtime, digest, code):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(dumps(code, mtime, digest))
+    os.rename(tmp_path, path)
+
+
+def dumps(code, mtime, digest):
+    writer = CodeWriter()
+    writer.add_code(code)
+    buf = []
+    dump_cache(buf, (MAGIC, VERSION, mtime, digest, writer.values, writer.codes))
+    payload = ''.join(buf)
+    return RMD5(payload).digest() + payload
+
+def loads(data, mtime, digest):
+    """Return the code stored in `data`, or None when it is stale or
+    damaged."""
+    if len(data) < CHECKSUM_SIZE:
+        return None
+    payload = data[CHECKSUM_SIZE:]
+    if RMD5(payload).digest() != data[:CHECKSUM_SIZE]:
+        return None
+    magic, version, cached_mtime, cached_digest, values, codes = load_cache(payload)
+    if magic != MAGIC or version != VERSION:
+        return None
+    if cached_mtime != mtime or cached_digest != digest:
+        return None
+    reader = CodeReader(values, codes)
+    return reader.read_codes()
+
+class CodeWriter(object):
+
+    def __init__(self):
+        self.values = []
+        self.codes = []
+
+    def add_value(self, value):
+        if isinstance(value, Null):
+            entry = (TAG_NULL, 0, 0.0, '', [])
+        elif isinstance(value, Bool):
+            entry = (TAG_TRUE if value.bool_val else TAG_FALSE, 0, 0.0, '', [])
+        elif isinstance(value, Int):
+            entry = (TAG_INT, value.int_val, 0.0, '', [])
+        elif isinstance(value, Float):
+            entry = (TAG_FLOAT, 0, value.float_val, '', [])
+        elif isinstance(value, Str):
+            entry = (TAG_STR, 0, 0.0, value.str_val, [])
+        elif isinstance(value, Array):
+            items = [self.add_value(el) for el in value.array_val]
+            entry = (TAG_ARRAY, 0, 0.0, '', items)
+        elif isinstance(value, Object):
+            items = []
+            for key, el in value.items():
+                items.append(self.add_value(Str(key)))
+                items.append(self.add_value(el))
+            entry = (TAG_OBJECT, 0, 0.0, '', items)
+        else:
+            raise Exception('unknown data type.')
+        self.values.append(entry)
+        return len(self.values) - 1
+
+    def add_code(self, code):
+        consts = [self.add_value(const) for const in code.consts]
+        codes = [self.add_code(child) for child in code.codes]
+        self.codes.append((code.name, code.instructions[:], consts,
+                           code.names[:], code.scope.labels[:], codes))
+        return len(self.codes) - 1
+
+
+class CodeReader(object):
+
+    def __init__(self, values, codes):
+        self.value_table = values
+        self.code_table = codes
+        self.values = []
+
+    def read_values(self):
+        for tag, int_val, float_val, str_val, items in self.value_table:
+            self.values.append(self.make_value(tag, int_val, float_val,
+                                               str_val, items))
+
+    def make_value(self, tag, int_val, float_val, str_val, items):
+        if tag == TAG_NULL:
+            return null
+        elif tag == TAG_TRUE:
+            return true
+        elif tag == TAG_FALSE:
+            return false
+        elif tag == TAG_INT:
+            return newint(int_val)
+        elif tag == TAG_FLOAT:
+            return Float(float_val)
+        elif tag == TAG_STR:
+            return Str(str_val)
+        elif tag == TAG_ARRAY:
+            return Array([self.get_value(i) for i in items])
+        elif tag == TAG_OBJECT:
+            _object = Object({})
+            for i in range(len(items) / 2):
+                key = self.get_value(items[i * 2])
+                assert isinstance(key, Str)
+                _object.setfield(key.str_val, self.get_value(items[i * 2 + 1]))
+            return _object
+        else:
+            raise ValueError('unknown value tag')
+
+    def get_value(self, index):
+        if index < 0 or index >= len(self.values):
+            raise ValueError('bad value reference')
+        return self.values[index]
+
+    def read_codes(self):
+        self.read_values()
+        codes = []
+        for name, instructions, consts, names, labels, children in self.code_table:
+            for index in children:
+                if index < 0 or index >= len(codes):
+                    raise ValueError('bad code reference')
+            codes.append(Code(name, instructions[:],
+                              [self.get_value(i) for i in consts],
+                              names[:], labels[:],
+                              [codes[i] for i in children]))
+        if len(codes) == 0:
+            raise ValueError('empty code table')
+        return codes[len(codes) - 1]
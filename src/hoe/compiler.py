@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+from hoe.grammar import parse_source
+from hoe.builtin import is_builtin
+from hoe.bytecode import (Code, LOAD_CONST, LOAD_LABEL, LOAD_PAYLOAD,
+                          GET_INDEX, BUILD_ARRAY, BUILD_OBJECT, STORE,
+                          CALL_BUILTIN, CALL_PROC, DEFINE_PROC, BEGIN,
+                          JUMP, JUMP_IF_FALSE, GET_ITER, FOR_ITER,
+                          TAIL_CALL_PROC, TAIL_BEGIN, BINARY_ADD,
+                          BINARY_SUB, BINARY_MUL, BINARY_DIV, BINARY_EQ,
+                          END_BODY, STORE_LOOP)
+from hoe.runtime import (Float, Str, Array, Object,
+                         null, true, false, newint)
+
+# Builtins that get a dedicated instruction when called with a two
+# element array literal, which then never has to be built.
+BINARY_OPS = {
+    '+': BINARY_ADD,
+    '-': BINARY_SUB,
+    '*': BINARY_MUL,
+    '/': BINARY_DIV,
+    '=': BINARY_EQ,
+}
+
+def compile_source(source_code, name='main'):
+    ast = parse_source(source_code)
+    return compile_statements(name, ast.children)
+
+def compile_statements(name, statements, tail=False):
+    compiler = Compiler(name)
+    for i in range(len(statements)):
+        last = i == len(statements) - 1
+        compiler.compile_statement(statements[i], tail and last)
+    return compiler.make_code()
+
+def extract_STRING(expr):
+    start = 1
+    end = max(len(expr.additional_info) -1, 1)
+    return expr.additional_info[start:end]
+
+
+class Compiler(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.instructions = []
+        self.consts = []
+        self.names = []
+        self.labels = ['^']
+        self.codes = []
+        self.index_caches = 0
+
+    def make_code(self):
+        return Code(self.name, self.instructions[:], self.consts[:],
+                    self.names[:], self.labels[:], self.codes[:])
+
+    def emit(self, op, arg=0):
+        self.instructions.append(op)
+        self.instructions.append(arg)
+        return len(self.instructions) - 2
+
+    def patch(self, pos, target):
+        self.instructions[pos + 1] = target
+
+    def position(self):
+        return len(self.instructions)
+
+    def add_const(self, value):
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def add_name(self, name):
+        for i in range(len(self.names)):
+            if self.names[i] == name:
+                return i
+        self.names.append(name)
+        return len(self.names) - 1
+
+    def add_label(self, label):
+        for i in range(len(self.labels)):
+            if self.labels[i] == label:
+                return i
+        self.labels.append(label)
+        return len(self.labels) - 1
+
+    def add_code(self, code):
+        self.codes.append(code)
+        return len(self.codes) - 1
+
+    def compile_statement(self, statement, tail=False):
+        if len(statement.children) == 1:
+            label = '^'
+            command = statement.children[0]
+        elif len(statement.children) == 2:
+            label = statement.children[0].additional_info
+            command = statement.children[1]
+        else:
+            raise Exception('unknown statement: %s' % statement)
+        self.compile_command(command, label, tail)
+        if has_loop_body(command):
+            self.emit(STORE_LOOP, self.add_label(label))
+        else:
+            self.emit(STORE, self.add_label(label))
+
+    def compile_command(self, command, label, tail=False):
+        if command.symbol == 'value':
+            self.compile_expression(command.children[0])
+        elif command.symbol == 'eval':
+            self.compile_eval(command, tail)
+        elif command.symbol == 'begin':
+            self.compile_begin(command, tail)
+        elif command.symbol == 'cond':
+            self.compile_cond(command, label, tail)
+        elif command.symbol == 'iter':
+            self.compile_iter(command, label)
+        elif command.symbol == 'proc':
+            self.compile_proc(command)
+        else:
+            raise Exception('unknown command %s' % command)
+
+    def compile_eval(self, command, tail):
+        func_name = extract_STRING(command.children[0])
+        if len(command.children) == 2 and func_name in BINARY_OPS:
+            payload = command.children[1]
+            if payload.symbol == 'array' and len(payload.children) == 2:
+                self.compile_expression(payload.children[0])
+                self.compile_expression(payload.children[1])
+                self.emit(BINARY_OPS[func_name])
+                return
+        if len(command.children) == 2:
+            self.compile_expression(command.children[1])
+        else:
+            self.emit(LOAD_CONST, self.add_const(null))
+        if is_builtin(func_name):
+            self.emit(CALL_BUILTIN, self.add_name(func_name))
+        elif tail:
+            self.emit(TAIL_CALL_PROC, self.add_name(func_name))
+        else:
+            self.emit(CALL_PROC, self.add_name(func_name))
+
+    def compile_proc(self, command):
+        def_name = extract_STRING(command.children[0])
+        code = compile_statements(def_name, command.children[1:], True)
+        self.emit(DEFINE_PROC, self.add_code(code))
+
+    def compile_begin(self, command, tail):
+        # named after the enclosing code, which a tail begin replaces
+        code = compile_statements('%s.begin' % self.name, command.children,
+                                  tail)
+        self.emit(TAIL_BEGIN if tail else BEGIN, self.add_code(code))
+
+    def compile_cond(self, command, label, tail):
+        commands_count = len(command.children)
+        if commands_count % 2 != 0:
+            raise Exception('cond branches not match.')
+        jumps_to_end = []
+        for i in range(commands_count / 2):
+            index = i * 2
+            self.compile_command(command.children[index], label)
+            jump_to_next = self.emit(JUMP_IF_FALSE)
+            self.compile_command(command.children[index + 1], label, tail)
+            jumps_to_end.append(self.emit(JUMP))
+            self.patch(jump_to_next, self.position())
+        self.emit(LOAD_CONST, self.add_const(null))
+        for jump in jumps_to_end:
+            self.patch(jump, self.position())
+
+    def compile_iter(self, command, label):
+        self.compile_expression(command.children[0])
+        self.emit(GET_ITER, self.add_label(label))
+        loop = self.position()
+        for_iter = self.emit(FOR_ITER)
+        for statement in command.children[1:]:
+            self.compile_statement(statement)
+        if len(command.children) > 1:
+            self.emit(END_BODY)
+        self.emit(JUMP, loop)
+        self.patch(for_iter, self.position())
+
+    def compile_expression(self, expr):
+        value = fold_constant(expr)
+        if value is not None:
+            self.emit(LOAD_CONST, self.add_const(value))
+        elif expr.symbol == 'array':
+            for child in expr.children:
+                self.compile_expression(child)
+            self.emit(BUILD_ARRAY, len(expr.children))
+        elif expr.symbol == 'object':
+            for child in expr.children:
+                self.compile_expression(child.children[0])
+                self.compile_expression(child.children[1])
+            self.emit(BUILD_OBJECT, len(expr.children))
+        elif expr.symbol == 'variable':
+            name = expr.children[0].additional_info
+            self.emit(LOAD_LABEL, self.add_label(name))
+            self.compile_indexes(expr.children[1:])
+        elif expr.symbol == 'payload':
+            self.emit(LOAD_PAYLOAD)
+            self.compile_indexes(expr.children)
+        else:
+            raise Exception('unknown expression')
+
+    def compile_indexes(self, indexes):
+        for index in indexes:
+            self.compile_expression(index)
+            self.emit(GET_INDEX, self.index_caches)
+            self.index_caches += 1
+
+
+def has_loop_body(command):
+    """Whether `command` may run the body of an `iter`, which leaves the
+    label of the statement on the last element."""
+    if command.symbol == 'iter':
+        return len(command.children) > 1
+    elif command.symbol == 'cond':
+        for child in command.children:
+            if has_loop_body(child):
+                return True
+    return False
+
+def fold_constant(expr):
+    """Return the value of a literal expression, or None if it reads a
+    label or the payload. Values are immutable, so the result is shared
+    by every evaluation of the expression."""
+    if expr.symbol == 'NUMBER':
+        return make_number(expr.additional_info)
+    elif expr.symbol == 'STRING':
+        return Str(extract_STRING(expr))
+    elif expr.symbol == 'array':
+        array = []
+        for child in expr.children:
+            element = fold_constant(child)
+            if element is None:
+                return None
+            array.append(element)
+        return Array(array)
+    elif expr.symbol == 'object':
+        _object = Object({})
+        for child in expr.children:
+            key = fold_constant(child.children[0])
+            value = fold_constant(child.children[1])
+            if not isinstance(key, Str) or value is None:
+                return None
+            _object.setfield(key.str_val, value)
+        return _object
+    elif expr.symbol == 'variable' or expr.symbol == 'payload':
+        return None
+    elif expr.additional_info == 'true':
+        return true
+    elif expr.additional_info == 'false':
+        return false
+    elif expr.additional_info == 'null':
+        return null
+    else:
+        return None
+
+def make_number(literal):
+    if '.' in literal:
+        return Float(float(literal))
+    else:
+        return newint(int(literal))
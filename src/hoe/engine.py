@@ -3,13 +3,40 @@
 import os
 
 from hoe.runtime import Env
-from hoe.interpreter import eval_source_code, eval_statements, eval_module
+from hoe.codecache import load_module_code
+from hoe.fileio import open_file, open_stdout
+from hoe.lib.socket import EventLoop
+from hoe.interpreter import (eval_source_code, eval_module, eval_module_code,
+                             eval_call, lookup_proc, call_proc, resume,
+                             Frame)
+from hoe.scheduler import Scheduler
+from hoe.pmap import pmap, cpu_count
+from hoe.profiler import Profiler
+from hoe.sampler import Sampler
 
 class Engine(object):
 
+    # proc_version is a plain field: it changes whenever an env holding
+    # procs comes or goes, and as a quasi-immutable field every change
+    # would throw away the machine code depending on it.
+    _immutable_fields_ = ['profiler?', 'sampler?']
+
     def __init__(self, executable):
         self.executable = executable
         self.stack = []
+        self.frames = []
+        self.modules = {}
+        self.module_hits = 0
+        self.module_misses = 0
+        self.proc_version = 0
+        self.proc_cache_hits = 0
+        self.proc_cache_misses = 0
+        self.stdout = open_stdout()
+        self.files = []
+        self.loop = EventLoop()
+        self.scheduler = Scheduler()
+        self.profiler = None
+        self.sampler = None
 
     def get_cwd(self):
         return os.getcwd()
@@ -17,24 +44,123 @@ class Engine(object):
     def current_stack(self):
         return self.stack[len(self.stack) - 1]
 
+    def invalidate_procs(self):
+        """Drop every cached proc lookup. Called whenever a proc is
+        defined or an env holding procs leaves the stack."""
+        self.proc_version += 1
+
+    def start_profiling(self):
+        """Count and time every proc and builtin call from now on."""
+        self.profiler = Profiler()
+        return self.profiler
+
+    def stop_profiling(self):
+        """Stop profiling and return the profiler with the totals."""
+        profiler = self.profiler
+        self.profiler = None
+        if profiler is not None:
+            profiler.finish()
+        return profiler
+
+    def start_sampling(self, interval):
+        """Sample the hoe stack every `interval` microseconds of cpu
+        time from now on."""
+        self.sampler = Sampler(interval)
+        self.sampler.start()
+        return self.sampler
+
+    def stop_sampling(self):
+        """Stop the timer and return the sampler with the stacks."""
+        sampler = self.sampler
+        self.sampler = None
+        if sampler is not None:
+            sampler.stop()
+        return sampler
+
+    def open_file(self, path, mode):
+        """Open a file that `close_files` closes if the script does not."""
+        file = open_file(path, mode)
+        self.files = [f for f in self.files if not f.closed]
+        self.files.append(file)
+        return file
+
+    def close_files(self):
+        """Flush and close every file the script left open."""
+        files = self.files
+        self.files = []
+        for file in files:
+            file.close()
+
     def run_macro_code(self, source_code):
         return eval_source_code(self, source_code)
 
+    def call(self, func_name, payload):
+        return eval_call(self, func_name, payload)
+
+    def lookup_proc(self, func_name):
+        return lookup_proc(self, func_name)
+
+    def call_proc(self, proc, payload):
+        return call_proc(self, proc, payload)
+
+    def spawn(self, func_name, payload):
+        """Create a task calling proc `func_name` with `payload`. It sees
+        the procs and labels visible here when spawned."""
+        proc = lookup_proc(self, func_name)
+        env = Env(proc.scope)
+        env.set_payload(payload)
+        frame = Frame(proc, env)
+        frame.memo = proc.memo
+        frame.payload = payload
+        return self.scheduler.new_task(self.stack + [env], [frame])
+
+    def resume(self):
+        return resume(self)
+
+    def pmap(self, func_name, items, workers):
+        """Map proc `func_name` over `items` in forked workers, one per
+        CPU unless `workers` is positive."""
+        if workers <= 0:
+            workers = cpu_count()
+        return pmap(self, func_name, items, workers)
+
     def run_module_code(self, source_code):
         env = eval_module(self, source_code)
         return env
 
+    def run_module(self, path):
+        return eval_module_code(self, load_module_code(path))
+
+    def import_module(self, path):
+        """Return the env of the module at `path`, evaluating it only once."""
+        if path in self.modules:
+            self.module_hits += 1
+            return self.modules[path]
+        self.module_misses += 1
+        env = self.run_module(path)
+        self.modules[path] = env
+        return env
+
     def run_script(self, path):
         try:
-            with open(path) as f:
-                try:
-                    eval_source_code(self, f.read())
-                    return 0
-                except Exception as e:
-                    print str(e)
-                    return 1
-        except KeyboardInterrupt as e:
-            return 1
-        except Exception as e:
-            print str(e)
-            return 1
+            try:
+                with open(path) as f:
+                    try:
+                        eval_source_code(self, f.read())
+                        return 0
+                    except Exception as e:
+                        self.report_error(str(e))
+                        return 1
+            except KeyboardInterrupt as e:
+                return 1
+            except Exception as e:
+                self.report_error(str(e))
+                return 1
+        finally:
+            self.close_files()
+            self.loop.close()
+            self.stdout.flush()
+
+    def report_error(self, message):
+        self.stdout.write(message)
+        self.stdout.write('\n')
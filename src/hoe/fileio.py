@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from rpython.rlib import rmmap
+
+from hoe.runtime import Seq, Cursor, Str
+
+BUFFER_SIZE = 65536
+
+MODES = {
+    'r': os.O_RDONLY,
+    'w': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+    'a': os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+}
+
+
+def open_file(path, mode):
+    """Open `path` for reading ("r"), writing ("w"), appending ("a"), or
+    reading through a read-only memory map ("m")."""
+    if mode == 'm':
+        fd = _open(path, os.O_RDONLY)
+        return MappedFile(path, fd)
+    if mode not in MODES:
+        raise Exception('unknown file mode: %s' % mode)
+    return File(path, _open(path, MODES[mode]), mode)
+
+def open_stdout():
+    """Return a buffered File writing to fd 1, line buffered on a tty."""
+    stdout = File('<stdout>', 1, 'a')
+    stdout.line_buffered = os.isatty(1)
+    return stdout
+
+def _open(path, flags):
+    try:
+        return os.open(path, flags, 0644)
+    except OSError:
+        raise Exception('cannot open file: %s' % path)
+
+
+class File(Seq):
+    """An open file.
+
+    Reads are served from a buffer refilled BUFFER_SIZE bytes at a time,
+    and writes are collected until the buffer is full, `flush` or
+    `close`. A line buffered file also flushes after every write that
+    contains a newline. Iterating a file yields its remaining lines.
+    """
+
+    def __init__(self, path, fd, mode):
+        self.path = path
+        self.fd = fd
+        self.mode = mode
+        self.closed = False
+        self.buffer = ''
+        self.pos = 0
+        self.pending = []
+        self.pending_size = 0
+        self.line_buffered = False
+
+    def check_readable(self):
+        if self.closed:
+            raise Exception('file is closed: %s' % self.path)
+        if self.mode != 'r' and self.mode != 'm':
+            raise Exception('file not open for reading: %s' % self.path)
+
+    def check_writable(self):
+        if self.closed:
+            raise Exception('file is closed: %s' % self.path)
+        if self.mode != 'w' and self.mode != 'a':
+            raise Exception('file not open for writing: %s' % self.path)
+
+    def fill(self):
+        """Read another chunk into the buffer. Returns False at the end."""
+        data = os.read(self.fd, BUFFER_SIZE)
+        if not data:
+            return False
+        if self.pos < len(self.buffer):
+            self.buffer = self.buffer[self.pos:] + data
+        else:
+            self.buffer = data
+        self.pos = 0
+        return True
+
+    def read(self, size):
+        """Read `size` bytes, or everything left if `size` is negative."""
+        self.check_readable()
+        if size < 0:
+            pieces = [self.buffer[self.pos:]]
+            self.buffer = ''
+            self.pos = 0
+            while True:
+                data = os.read(self.fd, BUFFER_SIZE)
+                if not data:
+                    break
+                pieces.append(data)
+            return ''.join(pieces)
+        while len(self.buffer) - self.pos < size:
+            if not self.fill():
+                break
+        start = self.pos
+        end = min(start + size, len(self.buffer))
+        self.pos = end
+        return self.buffer[start:end]
+
+    def readline(self):
+        """Read up to and including the next newline, or '' at the end."""
+        self.check_readable()
+        scanned = self.pos
+        while True:
+            assert scanned >= 0
+            end = self.buffer.find('\n', scanned)
+            if end >= 0:
+                end += 1
+                break
+            scanned = len(self.buffer) - self.pos
+            if not self.fill():
+                end = len(self.buffer)
+                break
+        start = self.pos
+        assert end >= start
+        self.pos = end
+        return self.buffer[start:end]
+
+    def write(self, data):
+        self.check_writable()
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= BUFFER_SIZE:
+            self.flush()
+        elif self.line_buffered and '\n' in data:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.pending_size == 0:
+            return
+        data = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        os.close(self.fd)
+        self.closed = True
+
+    def cursor(self):
+        return LineCursor(self)
+
+    def length(self):
+        # counting the lines would consume them
+        raise Exception('a file has no length: %s' % self.path)
+
+    def dump(self, out):
+        out.write(self.__str__())
+
+    def __str__(self):
+        return '<file %s>' % self.path
+
+
+class MappedFile(File):
+    """A file opened with mode "m", read through a read-only mmap."""
+
+    def __init__(self, path, fd):
+        File.__init__(self, path, fd, 'm')
+        size = os.fstat(fd).st_size
+        if size > 0:
+            self.map = rmmap.mmap(fd, size, access=rmmap.ACCESS_READ)
+        else:
+            self.map = None
+
+    def read(self, size):
+        self.check_readable()
+        if self.map is None:
+            return ''
+        return self.map.read(size)
+
+    def readline(self):
+        self.check_readable()
+        if self.map is None:
+            return ''
+        return self.map.readline()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+        self.closed = True
+
+
+class LineCursor(Cursor):
+    def __init__(self, file):
+        self.file = file
+
+    def next(self):
+        line = self.file.readline()
+        if not line:
+            return None
+        return Str(line)
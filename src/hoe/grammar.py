@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
-from rpython.rlib.parsing.parsing import ParseError
+from rpython.rlib.parsing.lexer import Token, SourcePos
+from rpython.rlib.parsing.parsing import ParseError, ErrorInformation
 from rpython.rlib.parsing.deterministic import LexerError
+from rpython.rlib.parsing.tree import Nonterminal, Symbol
 
+# The grammar of hoe, in the EBNF of rpython.rlib.parsing. The parser
+# below implements it by hand and builds the same trees its `to_ast`
+# would; lines whose first non-blank character is `#` are comments, and
+# lines may end with "\r\n".
 EBNF = """
 IDENTIFIER: "[a-zA-Z_][a-zA-Z0-9_]*";
 STRING: "\\\"([^\\"\\\\]|\\\\.)*\\\"";
@@ -34,24 +39,402 @@ array: ["["] (expression [","])* expression* ["]"];
 entry: expression [":"] expression;
 """
 
-regexes, rules, _to_ast = parse_ebnf(EBNF)
-parse = make_parse_function(regexes, rules, eof=True)
-to_ast = _to_ast()
+# Keywords are tokens of their own; `true`, `false` and `null` keep the
+# symbol names the EBNF parser gave them.
+KEYWORDS = {
+    'value': 'value', 'eval': 'eval', 'proc': 'proc', 'begin': 'begin',
+    'cond': 'cond', 'iter': 'iter', 'end': 'end',
+    'true': '__8_true', 'false': '__9_false', 'null': '__10_null',
+}
+TRUE = KEYWORDS['true']
+FALSE = KEYWORDS['false']
+NULL = KEYWORDS['null']
+PUNCTUATION = ':,[]{}$'
+EOF = 'EOF'
+
+COMMANDS = ['value', 'eval', 'proc', 'begin', 'cond', 'iter']
+EXPRESSIONS = ['STRING', 'NUMBER', 'true', 'false', 'null', '$',
+               'IDENTIFIER', '{', '[']
+
+
+# Byte classes of the lexer, computed once at import, and so frozen into
+# the binary at translation.
+BLANK = ' '
+LETTER = 'a'
+DIGIT = '0'
+OTHER = '?'
+
+def make_char_classes():
+    classes = []
+    for i in range(256):
+        c = chr(i)
+        if c == ' ' or c == '\n' or c == '\r':
+            classes.append(BLANK)
+        elif 'a' <= c <= 'z' or 'A' <= c <= 'Z' or c == '_':
+            classes.append(LETTER)
+        elif '0' <= c <= '9':
+            classes.append(DIGIT)
+        elif c in PUNCTUATION or c == '"' or c == '-' or c == '#':
+            classes.append(c)
+        else:
+            classes.append(OTHER)
+    return ''.join(classes)
+
+CHAR_CLASSES = make_char_classes()
+
+def char_class(c):
+    return CHAR_CLASSES[ord(c)]
+
+def is_digit(c):
+    return CHAR_CLASSES[ord(c)] == DIGIT
+
+def is_indent(c):
+    """Blanks only allowed in front of a comment."""
+    return c == '\t' or c == '\v' or c == '\f'
+
+
+class Lexer(object):
+    """Splits a source into tokens in a single pass, on demand.
+
+    The current token is kept in fields rather than in an object, since
+    the parser only needs Token objects for the symbols of the tree.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.pos = 0
+        self.lineno = 0
+        self.line_start = 0
+        self.blank_line = True
+        self.kind = EOF
+        self.start = 0
+        self.token_lineno = 0
+        self.token_column = 0
+
+    def newline(self, pos):
+        self.lineno += 1
+        self.line_start = pos + 1
+        self.blank_line = True
+
+    def source_pos(self):
+        return SourcePos(self.start, self.token_lineno, self.token_column)
+
+    def token(self):
+        start, end = self.start, self.pos
+        assert start >= 0 and end >= start
+        return Token(self.kind, self.source[start:end], self.source_pos())
+
+    def error(self, pos):
+        return LexerError(self.source, -1, SourcePos(
+            pos, self.lineno, pos - self.line_start))
+
+    def is_line_break(self, pos):
+        """Whether the character at `pos` ends a line: a newline, or a
+        carriage return not followed by one."""
+        c = self.source[pos]
+        if c == '\n':
+            return True
+        return c == '\r' and (pos + 1 >= len(self.source)
+                              or self.source[pos + 1] != '\n')
+
+    def comment_start(self, pos):
+        """Where the comment starting the line at `pos` begins, after its
+        indentation, or -1 if the line is not a comment."""
+        source = self.source
+        while pos < len(source) and (source[pos] == ' ' or is_indent(source[pos])):
+            pos += 1
+        if pos < len(source) and source[pos] == '#':
+            return pos
+        return -1
+
+    def skip_comment(self, pos):
+        """Where the line of the comment at `pos` ends."""
+        source = self.source
+        while pos < len(source) and source[pos] != '\n' and source[pos] != '\r':
+            pos += 1
+        return pos
+
+    def skip_blanks(self, pos):
+        """Return where the next token starts, after spaces, newlines and
+        comments, without moving the lexer."""
+        source = self.source
+        size = len(source)
+        blank_line = self.blank_line
+        while pos < size:
+            c = source[pos]
+            if self.is_line_break(pos):
+                blank_line = True
+            elif blank_line and (c == '#' or is_indent(c)):
+                comment = self.comment_start(pos)
+                if comment < 0:
+                    return pos
+                pos = self.skip_comment(comment)
+                continue
+            elif c != ' ' and c != '\r':
+                return pos
+            pos += 1
+        return size
+
+    def next_is(self, c):
+        """Whether the token after the current one starts with `c`."""
+        pos = self.skip_blanks(self.pos)
+        return pos < len(self.source) and self.source[pos] == c
+
+    def next(self):
+        source = self.source
+        size = len(source)
+        pos = self.pos
+        while pos < size:
+            c = source[pos]
+            if c == ' ':
+                pos += 1
+            elif self.is_line_break(pos):
+                self.newline(pos)
+                pos += 1
+            elif c == '\r':
+                pos += 1
+            elif self.blank_line and (c == '#' or is_indent(c)):
+                comment = self.comment_start(pos)
+                if comment < 0:
+                    break
+                pos = self.skip_comment(comment)
+            else:
+                break
+        self.start = pos
+        self.token_lineno = self.lineno
+        self.token_column = pos - self.line_start
+        if pos >= size:
+            self.pos = pos
+            self.kind = EOF
+            return
+        cls = char_class(source[pos])
+        if cls == LETTER:
+            end = pos + 1
+            while end < size:
+                cls = CHAR_CLASSES[ord(source[end])]
+                if cls != LETTER and cls != DIGIT:
+                    break
+                end += 1
+            assert pos >= 0
+            self.kind = KEYWORDS.get(source[pos:end], 'IDENTIFIER')
+        elif cls == '"':
+            self.kind = 'STRING'
+            end = self.scan_string(pos)
+        elif cls == '-' or cls == DIGIT:
+            self.kind = 'NUMBER'
+            end = self.scan_number(pos)
+        elif cls == OTHER or cls == '#' or cls == BLANK:
+            raise self.error(pos)
+        else:
+            self.kind = cls
+            end = pos + 1
+        self.pos = end
+        self.blank_line = False
+
+    def scan_string(self, start):
+        source = self.source
+        pos = start + 1
+        while True:
+            assert pos >= 0
+            end = source.find('"', pos)
+            if end < 0:
+                raise self.error(start)
+            escape = source.find('\\', pos, end)
+            newline = source.find('\n', pos, end)
+            if escape < 0 and newline < 0:
+                return end + 1
+            # slow path: walk the string up to the quote
+            while pos < end:
+                c = source[pos]
+                if c == '\\':
+                    pos += 1
+                    if pos >= len(source):
+                        raise self.error(start)
+                    c = source[pos]
+                if c == '\n':
+                    self.newline(pos)
+                pos += 1
+            if pos == end:
+                return end + 1
+            # the quote was escaped
+
+    def scan_number(self, start):
+        source = self.source
+        size = len(source)
+        pos = start
+        if source[pos] == '-':
+            pos += 1
+        if pos >= size or not is_digit(source[pos]):
+            raise self.error(start)
+        if source[pos] == '0':
+            pos += 1
+        else:
+            while pos < size and is_digit(source[pos]):
+                pos += 1
+        if pos + 1 < size and source[pos] == '.' and is_digit(source[pos + 1]):
+            pos += 2
+            while pos < size and is_digit(source[pos]):
+                pos += 1
+        if pos < size and (source[pos] == 'e' or source[pos] == 'E'):
+            # the exponent is only part of the number if it has digits
+            end = pos + 1
+            if end < size and (source[end] == '+' or source[end] == '-'):
+                end += 1
+            if end < size and is_digit(source[end]):
+                while end < size and is_digit(source[end]):
+                    end += 1
+                pos = end
+        return pos
+
+
+class Parser(object):
+    """Recursive-descent parser, reading the tokens of a Lexer."""
+
+    def __init__(self, source):
+        self.lexer = Lexer(source)
+        self.lexer.next()
+
+    def error(self, expected):
+        source_pos = self.lexer.source_pos()
+        return ParseError(source_pos, ErrorInformation(source_pos.i, expected))
+
+    def expect(self, kind):
+        if self.lexer.kind != kind:
+            raise self.error([kind])
+        self.lexer.next()
+
+    def symbol(self):
+        token = self.lexer.token()
+        self.lexer.next()
+        return Symbol(token.name, token.source, token)
+
+    def parse_main(self):
+        statements = [self.parse_statement()]
+        while self.lexer.kind != EOF:
+            statements.append(self.parse_statement())
+        return Nonterminal('main', statements)
+
+    def parse_statement(self):
+        if self.lexer.kind == 'IDENTIFIER':
+            if not self.lexer.next_is(':'):
+                raise self.error(COMMANDS)
+            label = self.symbol()
+            self.lexer.next()
+            return Nonterminal('statement', [label, self.parse_command()])
+        return Nonterminal('statement', [self.parse_command()])
+
+    def parse_statements(self):
+        """Statements up to and including the closing `end`."""
+        statements = []
+        while self.lexer.kind != 'end':
+            if self.lexer.kind != 'IDENTIFIER' and self.lexer.kind not in COMMANDS:
+                raise self.error(['IDENTIFIER'] + COMMANDS + ['end'])
+            statements.append(self.parse_statement())
+        self.lexer.next()
+        return statements
+
+    def parse_command(self):
+        kind = self.lexer.kind
+        if kind == 'value':
+            self.lexer.next()
+            return Nonterminal('value', [self.parse_expression()])
+        elif kind == 'eval':
+            self.lexer.next()
+            children = [self.string()]
+            if self.starts_expression():
+                children.append(self.parse_expression())
+            return Nonterminal('eval', children)
+        elif kind == 'proc':
+            self.lexer.next()
+            children = [self.string()]
+            children.extend(self.parse_statements())
+            return Nonterminal('proc', children)
+        elif kind == 'begin':
+            self.lexer.next()
+            return Nonterminal('begin', self.parse_statements())
+        elif kind == 'cond':
+            self.lexer.next()
+            commands = []
+            while self.lexer.kind != 'end':
+                if self.lexer.kind not in COMMANDS:
+                    raise self.error(COMMANDS + ['end'])
+                commands.append(self.parse_command())
+            self.lexer.next()
+            return Nonterminal('cond', commands)
+        elif kind == 'iter':
+            self.lexer.next()
+            children = [self.parse_expression()]
+            children.extend(self.parse_statements())
+            return Nonterminal('iter', children)
+        raise self.error(COMMANDS)
+
+    def string(self):
+        if self.lexer.kind != 'STRING':
+            raise self.error(['STRING'])
+        return self.symbol()
+
+    def starts_expression(self):
+        kind = self.lexer.kind
+        return (kind == 'STRING' or kind == 'NUMBER' or kind == 'IDENTIFIER'
+                or kind == '$' or kind == '[' or kind == '{'
+                or kind == TRUE or kind == FALSE or kind == NULL)
+
+    def parse_expression(self):
+        kind = self.lexer.kind
+        if kind == 'STRING' or kind == 'NUMBER':
+            return self.symbol()
+        elif kind == TRUE or kind == FALSE or kind == NULL:
+            return self.symbol()
+        elif kind == 'IDENTIFIER':
+            children = [self.symbol()]
+            self.parse_indexes(children)
+            return Nonterminal('variable', children)
+        elif kind == '$':
+            self.lexer.next()
+            children = []
+            self.parse_indexes(children)
+            return Nonterminal('payload', children)
+        elif kind == '[':
+            self.lexer.next()
+            return Nonterminal('array', self.parse_items(']', False))
+        elif kind == '{':
+            self.lexer.next()
+            return Nonterminal('object', self.parse_items('}', True))
+        raise self.error(EXPRESSIONS)
+
+    def parse_indexes(self, children):
+        while self.lexer.kind == '[':
+            self.lexer.next()
+            children.append(self.parse_expression())
+            self.expect(']')
+
+    def parse_items(self, close, entries):
+        """Items up to `close`. Items are separated by commas, up to the
+        first one that is not followed by a comma; the rest must not be.
+        """
+        items = []
+        separated = True
+        while self.starts_expression():
+            if entries:
+                key = self.parse_expression()
+                self.expect(':')
+                item = Nonterminal('entry', [key, self.parse_expression()])
+            else:
+                item = self.parse_expression()
+            items.append(item)
+            if separated and self.lexer.kind == ',':
+                self.lexer.next()
+            else:
+                separated = False
+        self.expect(close)
+        return items
 
-def ignore_comment(content):
-    lines = content.splitlines()
-    return '\n'.join(
-        [n for n in lines if not n.strip().startswith('#')]
-    )
 
 def parse_source(content):
     try:
-        source = ignore_comment(content)
-        tree = parse(source)
-        ast = to_ast.transform(tree)
-        return ast
+        return Parser(content).parse_main()
     except ParseError as e:
-        print(e.nice_error_message('syntax error'))
+        print(e.nice_error_message('syntax error', content))
         raise e
     except LexerError as e:
         print(e.nice_error_message('syntax error'))
@@ -1,270 +1,477 @@
 # -*- coding: utf-8 -*-
 
-from hoe.grammar import parse_source
-from hoe.builtin import is_builtin, builtin, builtin_bool
+from rpython.rlib import jit
+
+from hoe.compiler import compile_source
+from hoe.builtin import (is_builtin, builtin, builtin_bool,
+                         builtin_plus_atom, builtin_minus_atom,
+                         builtin_mul_atom, builtin_div_atom, builtin_eq_pair)
+from hoe.bytecode import (LOAD_CONST, LOAD_LABEL, LOAD_PAYLOAD,
+                          GET_INDEX, BUILD_ARRAY, BUILD_OBJECT, STORE,
+                          CALL_BUILTIN, CALL_PROC, DEFINE_PROC, BEGIN,
+                          JUMP, JUMP_IF_FALSE, GET_ITER, FOR_ITER,
+                          TAIL_CALL_PROC, TAIL_BEGIN, BINARY_ADD,
+                          BINARY_SUB, BINARY_MUL, BINARY_DIV, BINARY_EQ,
+                          END_BODY, STORE_LOOP, OPNAMES)
+from hoe.profiler import KIND_PROC, KIND_BUILTIN
 from hoe.runtime import (Env, Type, Int, Float,
                          Str, Bool, Null, Array,
-                         Object,
-                         null, true, false)
+                         Object, Seq,
+                         null, true, false, newint)
 
 
 def eval(engine, source_code):
     return eval_source_code(engine, source_code)
 
 def eval_source_code(engine, source_code):
-    ast = parse_source(source_code)
-    return eval_statements(engine, ast.children)
+    code = compile_source(source_code)
+    return eval_code(engine, code)
+
+def eval_code(engine, code):
+    if len(engine.stack) == 0:
+        engine.stack.append(Env(code.scope))
+    env = engine.current_stack()
+    env.adopt(code.scope)
+    return execute(engine, Frame(code, env))
 
 def eval_module(engine, source_code):
-    ast = parse_source(source_code)
-    env = Env()
+    code = compile_source(source_code, 'module')
+    return eval_module_code(engine, code)
+
+def eval_module_code(engine, code):
+    env = Env(code.scope)
     engine.stack.append(env)
-    for statement in ast.children:
-        eval_statement(engine, statement)
-    engine.stack.pop()
-    del env.namespace['^']
+    execute(engine, Frame(code, env))
     return env
 
 
-def eval_statements(engine, statements):
-    for statement in statements:
-        eval_statement(engine, statement)
-    return engine.stack.pop().present()
+class Frame(object):
+    """Execution state of a code object, kept on `engine.frames`."""
+
+    def __init__(self, code, env):
+        self.code = code
+        self.env = env
+        self.pc = 0
+        self.stack = []
+        self.iterators = []
+        self.memo = None
+        self.payload = null
+        self.profiled = False
+        self.ran_body = False
+
+
+def get_printable_location(pc, code):
+    # the merge point is also reached past the last instruction, where the
+    # frame returns
+    if pc >= len(code.instructions):
+        return '%s:%d <return>' % (code.name, pc)
+    return '%s:%d %s' % (code.name, pc, OPNAMES[code.instructions[pc]])
+
+jitdriver = jit.JitDriver(greens=['pc', 'code'],
+                          reds=['base', 'frame', 'engine'],
+                          get_printable_location=get_printable_location)
+
+def execute(engine, frame):
+    """Run `frame` and return its result.
+
+    The env of the frame must be on top of `engine.stack`, and it is
+    popped when the frame returns. Procs and begin blocks get frames of
+    their own on `engine.frames` instead of recursing on the host stack,
+    and calls in tail position replace the calling frame.
+    """
+    base = len(engine.frames)
+    engine.frames.append(frame)
+    return run_frames(engine, base)
+
+def resume(engine):
+    """Continue the frames of a suspended task. Returns its result, or
+    None if it was suspended again."""
+    return run_frames(engine, 0)
+
+def run_frames(engine, base):
+    frame = engine.frames[len(engine.frames) - 1]
+    code = frame.code
+    pc = frame.pc
+    while True:
+        jitdriver.jit_merge_point(pc=pc, code=code, base=base, frame=frame,
+                                  engine=engine)
+        if pc >= len(code.instructions):
+            result = pop_env(engine).present()
+            if frame.memo is not None:
+                frame.memo.put(frame.payload, result)
+            if frame.profiled:
+                engine.profiler.exit()
+            engine.frames.pop()
+            if len(engine.frames) == base:
+                return result
+            frame = engine.frames[len(engine.frames) - 1]
+            frame.stack.append(result)
+            code = frame.code
+            pc = frame.pc
+            continue
+        if engine.sampler is not None:
+            engine.sampler.poll(engine, pc)
+        op = code.instructions[pc]
+        arg = code.instructions[pc + 1]
+        pc += 2
+        env = frame.env
+        stack = frame.stack
+        if op == LOAD_CONST:
+            stack.append(code.consts[arg])
+        elif op == LOAD_LABEL:
+            value = env.slots[arg]
+            if value is None:
+                raise Exception('undefined label: %s' % code.scope.labels[arg])
+            stack.append(value)
+        elif op == LOAD_PAYLOAD:
+            stack.append(eval_payload(engine))
+        elif op == GET_INDEX:
+            index = stack.pop()
+            cache = code.index_caches[arg]
+            stack.append(get_value_by_index(stack.pop(), index, cache))
+        elif op == BUILD_ARRAY:
+            stack.append(eval_array(stack, arg))
+        elif op == BUILD_OBJECT:
+            stack.append(eval_object(stack, arg))
+        elif op == STORE:
+            eval_store(env, arg, stack.pop())
+        elif op == STORE_LOOP:
+            if frame.ran_body:
+                frame.ran_body = False
+                eval_store(env, 0, stack.pop())
+            else:
+                eval_store(env, arg, stack.pop())
+        elif op == END_BODY:
+            frame.ran_body = True
+        elif op >= BINARY_ADD and op <= BINARY_EQ:
+            right = stack.pop()
+            left = stack.pop()
+            if engine.profiler is None:
+                stack.append(binary_op(op, left, right))
+            else:
+                stack.append(profile_binary_op(engine, op, left, right))
+        elif op == CALL_BUILTIN:
+            if engine.sampler is not None:
+                frame.pc = pc # builtins may run procs on top of it
+            result = call_builtin(engine, code.names[arg], stack.pop())
+            if engine.scheduler.switching:
+                engine.scheduler.switching = False
+                if base != 0:
+                    raise Exception('cannot switch tasks inside a callback of a builtin.')
+                frame.pc = pc
+                return None
+            stack.append(result)
+        elif op == CALL_PROC or op == TAIL_CALL_PROC:
+            proc = jit.promote(lookup_cached_proc(engine, code, arg))
+            payload = stack.pop()
+            if proc.memo is not None:
+                result = proc.memo.get(payload)
+                if result is not None:
+                    if engine.profiler is not None:
+                        engine.profiler.enter(KIND_PROC, proc.name)
+                        engine.profiler.exit()
+                    stack.append(result)
+                    continue
+            if op == TAIL_CALL_PROC and can_drop_frame(frame):
+                drop_frame(engine)
+            else:
+                frame.pc = pc
+            callee_env = Env(proc.scope)
+            callee_env.set_payload(payload)
+            frame = push_frame(engine, proc, callee_env)
+            frame.memo = proc.memo
+            frame.payload = payload
+            if engine.profiler is not None:
+                engine.profiler.enter(KIND_PROC, proc.name)
+                frame.profiled = True
+            code = proc
+            pc = 0
+            # recursive procs never jump backwards, so trace from entry
+            jitdriver.can_enter_jit(pc=pc, code=code, base=base,
+                                    frame=frame, engine=engine)
+        elif op == BEGIN or op == TAIL_BEGIN:
+            block = code.codes[arg]
+            block_env = Env(block.scope)
+            if op == TAIL_BEGIN and can_drop_frame(frame):
+                if env.has_payload:
+                    block_env.set_payload(env.payload)
+                drop_frame(engine)
+            else:
+                frame.pc = pc
+            frame = push_frame(engine, block, block_env)
+            code = block
+            pc = 0
+        elif op == DEFINE_PROC:
+            proc = code.codes[arg]
+            env.define_proc(proc.name, proc)
+            engine.invalidate_procs()
+            stack.append(null)
+        elif op == JUMP:
+            if arg < pc:
+                jitdriver.can_enter_jit(pc=arg, code=code, base=base,
+                                        frame=frame, engine=engine)
+            pc = arg
+        elif op == JUMP_IF_FALSE:
+            if not type_cast_to_bool(engine, stack.pop()).bool_val:
+                pc = arg
+        elif op == GET_ITER:
+            frame.iterators.append(eval_iter(env, arg, stack.pop()))
+        elif op == FOR_ITER:
+            iterator = frame.iterators[len(frame.iterators) - 1]
+            if not iterator.step(env):
+                frame.iterators.pop()
+                stack.append(iterator.result)
+                pc = arg
+        else:
+            raise Exception('unknown opcode: %d' % op)
 
-def eval_statement(engine, statement):
-    if len(engine.stack) == 0:
-        engine.stack.append(Env())
+def push_frame(engine, code, env):
+    frame = Frame(code, env)
+    engine.stack.append(env)
+    engine.frames.append(frame)
+    return frame
 
-    if len(statement.children) == 1:
-        return eval_statement_without_identifier(engine, statement)
-    elif len(statement.children) == 2:
-        return eval_statement_with_identifier(engine, statement)
-    else:
-        raise Exception('unknown statement: %s' % statement)
-
-
-def eval_statement_with_identifier(engine, statement):
-    stack = engine.current_stack()
-    stack.identifier = statement.children[0].additional_info
-    val = eval_command(engine, statement.children[1])
-    stack.push(val)
-    return val
-
-def eval_statement_without_identifier(engine, statement):
-    stack = engine.current_stack()
-    stack.identifier = '^'
-    val = eval_command(engine, statement.children[0])
-    stack.push(val)
-    return val
-
-def eval_command(engine, statement):
-    if statement.symbol == 'value':
-        return eval_value(engine, statement)
-    elif statement.symbol == 'eval':
-        return eval_eval(engine, statement)
-    elif statement.symbol == 'begin':
-        return eval_begin(engine, statement)
-    elif statement.symbol == 'cond':
-        return eval_cond(engine, statement)
-    elif statement.symbol == 'iter':
-        return eval_iter(engine, statement)
-    elif statement.symbol == 'proc':
-        return eval_proc(engine, statement)
-    else:
-        raise Exception('unknown command %s' % statement)
+def can_drop_frame(frame):
+    # Procs defined in the env stay visible to callees, so it must outlive
+    # them, and a pure proc has to see its result to remember it.
+    return len(frame.env.defs) == 0 and frame.memo is None
+
+def drop_frame(engine):
+    pop_env(engine)
+    frame = engine.frames.pop()
+    if frame.profiled:
+        engine.profiler.exit()
+
+def eval_store(env, slot, value):
+    env.slots[slot] = value
+    env.slots[0] = value
 
-def eval_eval(engine, statement):
-    def_STRING = statement.children[0]
-    func_name = extract_STRING(def_STRING)
-    payload = eval_expression(engine, statement.children[1]) \
-            if len(statement.children) == 2 else null
+def eval_call(engine, func_name, payload):
     if is_builtin(func_name):
+        return call_builtin(engine, func_name, payload)
+    return eval_eval(engine, func_name, payload)
+
+BINARY_NAMES = ['+', '-', '*', '/', '=']
+
+def binary_op(op, left, right):
+    if op == BINARY_ADD:
+        return builtin_plus_atom(left, right)
+    elif op == BINARY_SUB:
+        return builtin_minus_atom(left, right)
+    elif op == BINARY_MUL:
+        return builtin_mul_atom(left, right)
+    elif op == BINARY_DIV:
+        return builtin_div_atom(left, right)
+    return builtin_eq_pair(left, right)
+
+def profile_binary_op(engine, op, left, right):
+    """`binary_op`, counted as a call of its builtin."""
+    profiler = engine.profiler
+    profiler.enter(KIND_BUILTIN, BINARY_NAMES[op - BINARY_ADD])
+    try:
+        return binary_op(op, left, right)
+    finally:
+        profiler.exit()
+
+def call_builtin(engine, func_name, payload):
+    profiler = engine.profiler
+    if profiler is None:
         return builtin(engine, func_name, payload)
-    statements = None
+    profiler.enter(KIND_BUILTIN, func_name)
+    try:
+        return builtin(engine, func_name, payload)
+    finally:
+        profiler.exit()
+
+def eval_eval(engine, func_name, payload):
+    return call_proc(engine, lookup_proc(engine, func_name), payload)
+
+def lookup_proc(engine, func_name):
     for env in reversed(engine.stack):
         if env.has_proc(func_name):
-            statements = env.get_proc(func_name)
-            break
-    if not statements:
-        raise Exception('unknown def: %s' % func_name)
-    env = Env()
-    env.set('$', payload)
+            return env.get_proc(func_name)
+    raise Exception('unknown def: %s' % func_name)
+
+def lookup_cached_proc(engine, code, index):
+    cache = code.call_caches[index]
+    if cache.version == engine.proc_version:
+        engine.proc_cache_hits += 1
+        return cache.proc
+    engine.proc_cache_misses += 1
+    proc = lookup_proc(engine, code.names[index])
+    cache.version = engine.proc_version
+    cache.proc = proc
+    return proc
+
+def call_proc(engine, proc, payload):
+    if proc.memo is not None:
+        result = proc.memo.get(payload)
+        if result is not None:
+            if engine.profiler is not None:
+                engine.profiler.enter(KIND_PROC, proc.name)
+                engine.profiler.exit()
+            return result
+    env = Env(proc.scope)
+    env.set_payload(payload)
     engine.stack.append(env)
-    return eval_statements(engine, statements)
-
-def eval_proc(engine, statement):
-    def_name = extract_STRING(statement.children[0])
-    engine.current_stack().define_proc(def_name, statement.children[1:])
-    return null
+    frame = Frame(proc, env)
+    frame.memo = proc.memo
+    frame.payload = payload
+    if engine.profiler is not None:
+        engine.profiler.enter(KIND_PROC, proc.name)
+        frame.profiled = True
+    return execute(engine, frame)
+
+def pop_env(engine):
+    env = engine.stack.pop()
+    if len(env.defs) != 0:
+        engine.invalidate_procs()
+    return env
 
-def eval_iter(engine, statement):
-    iter_object = eval_expression(engine, statement.children[0])
+def eval_iter(env, slot, iter_object):
     if isinstance(iter_object, Bool):
-        return eval_iter_bool(engine, iter_object, statement.children[1:])
+        return IterBool(iter_object)
     elif isinstance(iter_object, Int):
-        return eval_iter_n_times(engine, iter_object, statement.children[1:])
+        return IterNTimes(env, slot, iter_object)
     elif isinstance(iter_object, Array):
-        return eval_iter_array(engine, iter_object, statement.children[1:])
+        return IterArray(slot, iter_object)
     elif isinstance(iter_object, Str):
-        return eval_iter_str_chars(engine, iter_object, statement.children[1:])
+        return IterStrChars(slot, iter_object)
+    elif isinstance(iter_object, Seq):
+        return IterSeq(slot, iter_object)
     else:
         raise Exception('not implemented: iter')
 
-def eval_iter_str_chars(engine, string, statements):
-    if not string.str_val:
-        return string
-    stack = engine.current_stack()
-    iter_obj_identifier = stack.identifier
-    for char in string.str_val:
-        stack.set(iter_obj_identifier, Str(char))
-        for statement in statements:
-            eval_statement(engine, statement)
-    return string
-
-def eval_iter_bool(engine, bool, statements):
-    if not bool.bool_val:
-        return false
-    while True:
-        for statement in statements:
-            eval_statement(engine, statement)
-
-def eval_iter_array(engine, array, statements):
-    stack = engine.current_stack()
-    iter_obj_identifier = stack.identifier
-    for el in array.array_val:
-        stack.set(iter_obj_identifier, el)
-        for statement in statements:
-            eval_statement(engine, statement)
-    return array
-
-def eval_iter_n_times(engine, n, statements):
-    stack = engine.current_stack()
-    iter_obj_identifier = stack.identifier
-    stack.set(iter_obj_identifier, Int(0))
-    x = 0
-    while x < n.int_val:
-        for statement in statements:
-            eval_statement(engine, statement)
-        x += 1
-        stack.set(iter_obj_identifier, Int(x))
-    return n
+
+class Iterator(object):
+    """Loop state of an `iter` command.
+
+    `step` binds the next element to the iter label and returns True, or
+    returns False once the loop is exhausted and `result` is its value.
+    """
+
+    def __init__(self, result):
+        self.result = result
+
+    def step(self, env):
+        return False
+
+class IterBool(Iterator):
+    def __init__(self, bool):
+        Iterator.__init__(self, bool)
+        self.bool_val = bool.bool_val
+    def step(self, env):
+        return self.bool_val
+
+class IterNTimes(Iterator):
+    def __init__(self, env, slot, n):
+        Iterator.__init__(self, n)
+        self.slot = slot
+        self.n = n.int_val
+        self.x = 0
+        env.slots[slot] = newint(0)
+    def step(self, env):
+        # the label ends on n once the loop is done
+        env.slots[self.slot] = newint(self.x)
+        if self.x >= self.n:
+            return False
+        self.x += 1
+        return True
+
+class IterArray(Iterator):
+    def __init__(self, slot, array):
+        Iterator.__init__(self, array)
+        self.slot = slot
+        self.array = array
+        self.index = 0
+    def step(self, env):
+        if self.index >= self.array.length():
+            return False
+        env.slots[self.slot] = self.array.getitem(self.index)
+        self.index += 1
+        return True
+
+class IterStrChars(Iterator):
+    def __init__(self, slot, string):
+        Iterator.__init__(self, string)
+        self.slot = slot
+        self.str_val = string.str_val
+        self.index = 0
+    def step(self, env):
+        if self.index >= len(self.str_val):
+            return False
+        env.slots[self.slot] = Str(self.str_val[self.index])
+        self.index += 1
+        return True
+
+class IterSeq(Iterator):
+    def __init__(self, slot, seq):
+        Iterator.__init__(self, seq)
+        self.slot = slot
+        self.cursor = seq.cursor()
+    def step(self, env):
+        el = self.cursor.next()
+        if el is None:
+            return False
+        env.slots[self.slot] = el
+        return True
+
 
 def type_cast_to_bool(engine, val):
     return builtin_bool(engine, val)
 
-def eval_cond(engine, statement):
-    statements_count = len(statement.children)
-    if statements_count % 2 != 0:
-        raise Exception('cond branches not match.')
-    for i in range(statements_count / 2):
-        index = i * 2
-        condition, block = statement.children[index], statement.children[index+1]
-        if type_cast_to_bool(engine, eval_command(engine, condition)).bool_val:
-            return eval_command(engine, block)
-    return null
-
-def eval_value(engine, statement):
-    return eval_expression(engine, statement.children[0])
-
-def eval_begin(engine, statement):
-    begin_stack = Env()
-    engine.stack.append(begin_stack)
-    for stmt in statement.children:
-        eval_statement(engine, stmt)
-    return engine.stack.pop().present()
-
-def eval_expression(engine, expr):
-    if expr.symbol == 'NUMBER' and '.' in expr.additional_info:
-        return eval_float(engine, expr)
-    elif expr.symbol == 'NUMBER':
-        return eval_int(engine, expr)
-    elif expr.symbol == 'STRING':
-        return eval_str(engine, expr)
-    elif expr.symbol == 'array':
-        return eval_array(engine, expr)
-    elif expr.symbol == 'object':
-        return eval_object(engine, expr)
-    elif expr.symbol == 'variable':
-        return eval_variable(engine, expr)
-    elif expr.symbol == 'payload':
-        return eval_payload(engine, expr)
-    elif expr.additional_info == 'true':
-        return true
-    elif expr.additional_info == 'false':
-        return false
-    elif expr.additional_info == 'null':
-        return null
-    else:
-        raise Exception('unknown expression')
-
-def eval_payload(engine, expr):
+def eval_payload(engine):
     for env in reversed(engine.stack):
-        if env.has('$'):
-            val = env.get('$')
-            if len(expr.children) == 0:
-                return val
-            else:
-                for index in expr.children:
-                    val = get_value_by_index(engine, val, index)
-                return val
+        if env.has_payload:
+            return env.payload
     raise Exception('invalid payload getter.')
 
-def eval_payload_with_index(engine, expr):
-    for getter_ast in expr.children:
-        getter = eval_expression(engine, getter_ast)
-        if isinstance(val, Array) and isinstance(getter, Int):
-            val = val.array_val[getter.int_val]
-        elif isinstance(val, Object) and isinstance(getter, Str):
-            val = val.object_val[getter.str_val] # XXX object_val need to be raw str.
-        else:
-            raise Exception('invalid payload getter.')
-    return val
-
-def get_value_by_index(engine, var, index_ast):
-    indexer = eval_expression(engine, index_ast)
+def get_value_by_index(var, indexer, cache=None):
     if isinstance(indexer, Str) and isinstance(var, Object):
-        return var.object_val[indexer.str_val]
+        return get_field(var, indexer.str_val, cache)
     elif isinstance(indexer, Int) and isinstance(var, Array):
-        return var.array_val[indexer.int_val]
+        return var.getitem(indexer.int_val)
     else:
         raise Exception('unknown data type')
 
-def eval_variable(engine, expr):
-    stack = engine.current_stack()
-    val = stack.get(expr.children[0].additional_info)
-    if len(expr.children) >= 1:
-        for index in expr.children[1:]:
-            val = get_value_by_index(engine, val, index)
-    return val
-
-def eval_float(engine, expr):
-    return Float(float(expr.additional_info))
-
-def eval_int(engine, expr):
-    return Int(int(expr.additional_info))
-
-def extract_STRING(expr):
-    start = 1
-    end = max(len(expr.additional_info) -1, 1)
-    return expr.additional_info[start:end]
-
-def eval_str(engine, expr):
-    return Str(extract_STRING(expr))
-
-def eval_array(engine, expr):
-    array = []
-    for child in expr.children:
-        element = eval_expression(engine, child)
-        array.append(element)
+def get_field(var, key, cache):
+    shape = var.shape
+    if cache is not None and shape is not None:
+        if cache.shape is shape and cache.key == key:
+            return var.fields[cache.index]
+        index = shape.lookup(key)
+        if index >= 0:
+            cache.shape = shape
+            cache.key = key
+            cache.index = index
+            return var.fields[index]
+    value = var.getfield(key)
+    if value is None:
+        raise KeyError(key)
+    return value
+
+@jit.unroll_safe
+def eval_array(stack, count):
+    array = [null] * count
+    i = count - 1
+    while i >= 0:
+        array[i] = stack.pop()
+        i -= 1
     return Array(array)
 
-def eval_object(engine, expr):
-    _object = {}
-    for child in expr.children:
-        key = eval_expression(engine, child.children[0])
-        value = eval_expression(engine, child.children[1])
+@jit.unroll_safe
+def eval_object(stack, count):
+    _object = Object({})
+    entries = []
+    for i in range(count):
+        value = stack.pop()
+        key = stack.pop()
+        entries.append((key, value))
+    i = len(entries) - 1
+    while i >= 0:
+        key, value = entries[i]
         if not isinstance(key, Str):
             raise Exception('unknown data type.')
-        _object[key.str_val] = value
-    return Object(_object)
-
+        _object.setfield(key.str_val, value)
+        i -= 1
+    return _object
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import time
+
+from rpython.rlib import rposix
+from rpython.rtyper.lltypesystem import lltype, rffi
+from rpython.rtyper.tool import rffi_platform
+from rpython.translator.tool.cbuild import ExternalCompilationInfo
+
+eci = ExternalCompilationInfo(includes=['sys/epoll.h'])
+
+class CConfig(object):
+    _compilation_info_ = eci
+
+CConfig.epoll_data = rffi_platform.Struct('union epoll_data', [
+    ('fd', rffi.INT),
+])
+CConfig.epoll_event = rffi_platform.Struct('struct epoll_event', [
+    ('events', rffi.UINT),
+    ('data', CConfig.epoll_data),
+])
+
+CONSTANTS = ['EPOLLIN', 'EPOLLOUT', 'EPOLLERR', 'EPOLLHUP',
+             'EPOLL_CTL_ADD', 'EPOLL_CTL_MOD', 'EPOLL_CTL_DEL',
+             'EPOLL_CLOEXEC']
+for name in CONSTANTS:
+    setattr(CConfig, name, rffi_platform.ConstantInteger(name))
+
+cconfig = rffi_platform.configure(CConfig)
+
+epoll_event = cconfig['epoll_event']
+EPOLLIN = cconfig['EPOLLIN']
+EPOLLOUT = cconfig['EPOLLOUT']
+EPOLLERR = cconfig['EPOLLERR']
+EPOLLHUP = cconfig['EPOLLHUP']
+EPOLL_CTL_ADD = cconfig['EPOLL_CTL_ADD']
+EPOLL_CTL_MOD = cconfig['EPOLL_CTL_MOD']
+EPOLL_CTL_DEL = cconfig['EPOLL_CTL_DEL']
+EPOLL_CLOEXEC = cconfig['EPOLL_CLOEXEC']
+
+epoll_create1 = rffi.llexternal(
+    'epoll_create1', [rffi.INT], rffi.INT,
+    compilation_info=eci, save_err=rffi.RFFI_SAVE_ERRNO)
+epoll_ctl = rffi.llexternal(
+    'epoll_ctl', [rffi.INT, rffi.INT, rffi.INT, lltype.Ptr(epoll_event)],
+    rffi.INT, compilation_info=eci, save_err=rffi.RFFI_SAVE_ERRNO)
+epoll_wait = rffi.llexternal(
+    'epoll_wait', [rffi.INT, rffi.CArrayPtr(epoll_event), rffi.INT, rffi.INT],
+    rffi.INT, compilation_info=eci, save_err=rffi.RFFI_SAVE_ERRNO)
+
+
+class EPoll(object):
+    """A minimal wrapper of a Linux epoll instance."""
+
+    def __init__(self):
+        self.epfd = rffi.cast(lltype.Signed, epoll_create1(EPOLL_CLOEXEC))
+        if self.epfd < 0:
+            raise OSError(rposix.get_saved_errno(), 'epoll_create1 failed')
+
+    def ctl(self, op, fd, events):
+        with lltype.scoped_alloc(epoll_event) as ev:
+            ev.c_events = rffi.cast(rffi.UINT, events)
+            rffi.setintfield(ev.c_data, 'c_fd', fd)
+            result = rffi.cast(lltype.Signed, epoll_ctl(self.epfd, op, fd, ev))
+        if result < 0:
+            raise OSError(rposix.get_saved_errno(), 'epoll_ctl failed')
+
+    def register(self, fd, events):
+        self.ctl(EPOLL_CTL_ADD, fd, events)
+
+    def modify(self, fd, events):
+        self.ctl(EPOLL_CTL_MOD, fd, events)
+
+    def unregister(self, fd):
+        self.ctl(EPOLL_CTL_DEL, fd, 0)
+
+    def wait(self, timeout, maxevents):
+        """Return (fd, events) pairs of the ready fds, waiting at most
+        `timeout` milliseconds, or forever if it is negative. A wait
+        interrupted by a signal is resumed for the time left."""
+        ready = []
+        deadline = 0.0
+        if timeout > 0:
+            deadline = time.time() + timeout / 1000.0
+        with lltype.scoped_alloc(rffi.CArray(epoll_event), maxevents) as evs:
+            while True:
+                count = rffi.cast(lltype.Signed, epoll_wait(self.epfd, evs,
+                                                            maxevents, timeout))
+                if count >= 0:
+                    break
+                saved_errno = rposix.get_saved_errno()
+                if saved_errno != errno.EINTR:
+                    raise OSError(saved_errno, 'epoll_wait failed')
+                if timeout > 0:
+                    timeout = max(int((deadline - time.time()) * 1000), 0)
+            for i in range(count):
+                ev = evs[i]
+                ready.append((rffi.cast(lltype.Signed, ev.c_data.c_fd),
+                              rffi.cast(lltype.Signed, ev.c_events)))
+        return ready
+
+    def close(self):
+        if self.epfd >= 0:
+            os.close(self.epfd)
+            self.epfd = -1
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import errno
+
+from rpython.rlib import rsocket
+
+from hoe.runtime import Type, Str
+from hoe.lib.epoll import EPoll, EPOLLIN, EPOLLOUT, EPOLLERR, EPOLLHUP
+
+RECV_SIZE = 65536
+MAX_EVENTS = 256
+WOULD_BLOCK = [errno.EAGAIN, errno.EWOULDBLOCK]
+
+
+def hoe_gethostname():
+    return Str(rsocket.gethostname())
+
+
+class Socket(Type):
+    """A TCP socket. A non-blocking socket returns null from `accept` and
+    `recv` instead of waiting, and `send` may write only part of the
+    data."""
+
+    def __init__(self, rsock):
+        self.rsock = rsock
+        self.blocking = True
+        self.closed = False
+
+    def fileno(self):
+        return self.rsock.fd
+
+    def check_open(self):
+        if self.closed:
+            raise Exception('socket is closed.')
+
+    def setblocking(self, blocking):
+        self.check_open()
+        self.rsock.setblocking(blocking)
+        self.blocking = blocking
+
+    def accept(self):
+        """Return the next connection, or None if none is pending."""
+        self.check_open()
+        try:
+            fd, addr = self.rsock.accept()
+        except rsocket.CSocketError as e:
+            if e.errno in WOULD_BLOCK:
+                return None
+            raise Exception('accept failed: %s' % e.get_msg())
+        rsock = rsocket.RSocket(self.rsock.family, self.rsock.type,
+                                self.rsock.proto, fd)
+        return Socket(rsock)
+
+    def recv(self, size):
+        """Return up to `size` bytes, '' once the peer closed the
+        connection, or None if no data is ready yet."""
+        self.check_open()
+        try:
+            return self.rsock.recv(size)
+        except rsocket.CSocketError as e:
+            if e.errno in WOULD_BLOCK:
+                return None
+            raise Exception('recv failed: %s' % e.get_msg())
+
+    def send(self, data):
+        """Return how many bytes of `data` were sent."""
+        self.check_open()
+        try:
+            return self.rsock.send(data)
+        except rsocket.CSocketError as e:
+            if e.errno in WOULD_BLOCK:
+                return 0
+            raise Exception('send failed: %s' % e.get_msg())
+
+    def port(self):
+        return self.rsock.getsockname().get_port()
+
+    def close(self):
+        if not self.closed:
+            self.rsock.close()
+            self.closed = True
+
+    def __str__(self):
+        return '<socket %d>' % self.rsock.fd
+
+
+def listen(host, port, backlog):
+    try:
+        rsock = rsocket.RSocket()
+        rsock.setsockopt_int(rsocket.SOL_SOCKET, rsocket.SO_REUSEADDR, 1)
+        rsock.bind(rsocket.INETAddress(host, port))
+        rsock.listen(backlog)
+    except rsocket.SocketError as e:
+        raise Exception('cannot listen on %s:%d: %s' % (host, port,
+                                                        e.get_msg()))
+    return Socket(rsock)
+
+def connect(host, port):
+    try:
+        rsock = rsocket.RSocket()
+        rsock.connect(rsocket.INETAddress(host, port))
+    except rsocket.SocketError as e:
+        raise Exception('cannot connect to %s:%d: %s' % (host, port,
+                                                         e.get_msg()))
+    return Socket(rsock)
+
+
+class Watcher(object):
+    def __init__(self, socket, events, func_name):
+        self.socket = socket
+        self.events = events
+        self.func_name = func_name
+
+
+class EventLoop(object):
+    """Single threaded epoll loop calling a proc with every socket that
+    becomes ready for the events it is watched for."""
+
+    def __init__(self):
+        self.poll = None
+        self.watchers = {}
+        self.running = False
+
+    def watch(self, socket, mode, func_name):
+        """Watch `socket` for reading ("r"), writing ("w") or both ("rw"),
+        replacing an earlier watch of the same socket."""
+        socket.check_open()
+        events = 0
+        if 'r' in mode:
+            events |= EPOLLIN
+        if 'w' in mode:
+            events |= EPOLLOUT
+        if events == 0:
+            raise Exception('unknown watch mode: %s' % mode)
+        if self.poll is None:
+            self.poll = EPoll()
+        fd = socket.fileno()
+        if fd in self.watchers:
+            self.poll.modify(fd, events)
+        else:
+            self.poll.register(fd, events)
+        self.watchers[fd] = Watcher(socket, events, func_name)
+
+    def unwatch(self, socket):
+        """Stop watching `socket`. The epoll instance is closed with the
+        last watch and created again by the next one."""
+        fd = socket.fileno()
+        if fd in self.watchers:
+            del self.watchers[fd]
+            self.poll.unregister(fd)
+            if not self.watchers:
+                self.close()
+
+    def run(self, engine, timeout):
+        """Dispatch events until no socket is watched, `stop` is called,
+        or nothing happens for `timeout` milliseconds (negative waits
+        forever). Returns how many events were dispatched."""
+        self.running = True
+        dispatched = 0
+        while self.running and self.watchers:
+            ready = self.poll.wait(timeout, MAX_EVENTS)
+            if not ready:
+                break
+            for fd, events in ready:
+                watcher = self.watchers.get(fd, None)
+                if watcher is None or not self.running:
+                    continue
+                if events & (watcher.events | EPOLLERR | EPOLLHUP):
+                    dispatched += 1
+                    engine.call(watcher.func_name, watcher.socket)
+        self.running = False
+        return dispatched
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        """Forget every watch and close the epoll instance."""
+        self.watchers = {}
+        if self.poll is not None:
+            self.poll.close()
+            self.poll = None
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from rpython.rlib.objectmodel import r_dict, compute_hash, compute_identity_hash
+from rpython.rlib.rarithmetic import intmask
+
+from hoe.runtime import Int, Float, Str, Bool, Null, Array, Object, Seq
+
+DEFAULT_LIMIT = 1024
+
+
+def value_hash(value):
+    """Structural hash of a runtime value."""
+    if isinstance(value, Int):
+        return compute_hash(value.int_val)
+    elif isinstance(value, Float):
+        return compute_hash(value.float_val)
+    elif isinstance(value, Str):
+        return compute_hash(value.str_val)
+    elif isinstance(value, Bool):
+        return 1 if value.bool_val else 2
+    elif isinstance(value, Null):
+        return 3
+    elif isinstance(value, Array):
+        h = 0x345678
+        for i in range(value.length()):
+            h = intmask((h * 1000003) ^ value_hash(value.getitem(i)))
+        return h
+    elif isinstance(value, Object):
+        h = 0x456789
+        for key, el in value.items():
+            h ^= intmask(compute_hash(key) * 31 + value_hash(el))
+        return h
+    elif isinstance(value, Seq):
+        return compute_identity_hash(value)
+    else:
+        raise Exception('unknown data type.')
+
+def values_equal(left, right):
+    """Structural equality. Unlike `=`, 1 and 1.0 are different keys."""
+    if isinstance(left, Int) and isinstance(right, Int):
+        return left.int_val == right.int_val
+    elif isinstance(left, Float) and isinstance(right, Float):
+        return left.float_val == right.float_val
+    elif isinstance(left, Str) and isinstance(right, Str):
+        return left.str_val == right.str_val
+    elif isinstance(left, Bool) and isinstance(right, Bool):
+        return left.bool_val == right.bool_val
+    elif isinstance(left, Null) and isinstance(right, Null):
+        return True
+    elif isinstance(left, Array) and isinstance(right, Array):
+        if left.length() != right.length():
+            return False
+        for i in range(left.length()):
+            if not values_equal(left.getitem(i), right.getitem(i)):
+                return False
+        return True
+    elif isinstance(left, Object) and isinstance(right, Object):
+        if left.length() != right.length():
+            return False
+        for key, el in left.items():
+            other = right.getfield(key)
+            if other is None or not values_equal(el, other):
+                return False
+        return True
+    elif isinstance(left, Seq) and isinstance(right, Seq):
+        return left is right # lazy sequences may be unbounded
+    else:
+        return False
+
+
+class MemoEntry(object):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.prev = None
+        self.next = None
+
+
+class Memo(object):
+    """Bounded LRU cache of the results of a pure proc, keyed by payload."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = r_dict(values_equal, value_hash)
+        self.head = MemoEntry(None, None) # most recently used side
+        self.head.prev = self.head
+        self.head.next = self.head
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def size(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(entry)
+        self._link_first(entry)
+        return entry.value
+
+    def put(self, key, value):
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            entry.value = value
+            self._unlink(entry)
+            self._link_first(entry)
+            return
+        entry = MemoEntry(key, value)
+        self.entries[key] = entry
+        self._link_first(entry)
+        while len(self.entries) > self.limit:
+            last = self.head.prev
+            self._unlink(last)
+            del self.entries[last.key]
+            self.evictions += 1
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _link_first(self, entry):
+        entry.prev = self.head
+        entry.next = self.head.next
+        self.head.next.prev = entry
+        self.head.next = entry
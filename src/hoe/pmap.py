@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# `pmap` forks one worker per chunk of the input. Workers inherit every
+# loaded proc, call the proc on their chunk and write the results back
+# over a pipe: one status byte, then the encoded array of results or the
+# error message.
+#
+# A value is encoded as one tag byte followed by its payload: nothing for
+# null and booleans, 8 big-endian bytes for ints and floats, and a 4-byte
+# length followed by the bytes, items or key/value pairs for strings,
+# arrays and objects.
+
+import os
+
+from rpython.rlib import rposix
+from rpython.rlib.rarithmetic import intmask, r_ulonglong
+from rpython.rlib.rstruct.ieee import float_pack, float_unpack
+
+from hoe.runtime import (Int, Float, Str, Bool, Null, Array, Object,
+                         null, true, false, newint)
+
+STATUS_OK = 'o'
+STATUS_ERROR = 'e'
+
+TAG_NULL = 'n'
+TAG_TRUE = 't'
+TAG_FALSE = 'f'
+TAG_INT = 'i'
+TAG_FLOAT = 'd'
+TAG_STR = 's'
+TAG_ARRAY = 'a'
+TAG_OBJECT = 'o'
+
+
+def cpu_count():
+    try:
+        return max(rposix.cpu_count(), 1)
+    except OSError:
+        return 1
+
+def pmap(engine, func_name, items, workers):
+    """Return `func_name` called on every item, in order, using up to
+    `workers` processes."""
+    if workers > len(items):
+        workers = len(items)
+    if workers <= 1:
+        return [engine.call(func_name, item) for item in items]
+    engine.stdout.flush()
+    chunk = (len(items) + workers - 1) / workers
+    jobs = []
+    results = []
+    error = None
+    try:
+        start = 0
+        while start < len(items):
+            end = min(start + chunk, len(items))
+            assert end >= 0
+            jobs.append(start_worker(engine, func_name, items[start:end]))
+            start = end
+        for job in jobs:
+            data = read_all(job.fd)
+            job.finish()
+            if error is not None:
+                continue
+            if data.startswith(STATUS_OK):
+                chunk_results = decode_value(data[1:])
+                assert isinstance(chunk_results, Array)
+                results.extend(chunk_results.array_val)
+            elif data.startswith(STATUS_ERROR):
+                error = data[1:]
+            else:
+                error = 'worker %d exited without a result' % job.pid
+    finally:
+        # on errors, workers still writing fail on the closed pipe
+        for job in jobs:
+            job.finish()
+    if error is not None:
+        raise Exception('pmap failed: %s' % error)
+    return results
+
+
+class Job(object):
+    def __init__(self, pid, fd):
+        self.pid = pid
+        self.fd = fd
+        self.done = False
+
+    def finish(self):
+        """Close the pipe and reap the worker, once."""
+        if self.done:
+            return
+        self.done = True
+        os.close(self.fd)
+        os.waitpid(self.pid, 0)
+
+def start_worker(engine, func_name, items):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            try:
+                results = [engine.call(func_name, item) for item in items]
+                data = STATUS_OK + encode_value(Array(results))
+                status = 0
+            except Exception as e:
+                data = STATUS_ERROR + str(e)
+            engine.stdout.flush()
+            write_all(write_fd, data)
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    return Job(pid, read_fd)
+
+def read_all(fd):
+    pieces = []
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        pieces.append(data)
+    return ''.join(pieces)
+
+def write_all(fd, data):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def encode_value(value):
+    buf = []
+    write_value(buf, value)
+    return ''.join(buf)
+
+def decode_value(data):
+    reader = ValueReader(data)
+    value = reader.read_value()
+    if reader.pos != len(data):
+        raise ValueError('trailing data after value')
+    return value
+
+def write_value(buf, value):
+    if isinstance(value, Null):
+        buf.append(TAG_NULL)
+    elif isinstance(value, Bool):
+        buf.append(TAG_TRUE if value.bool_val else TAG_FALSE)
+    elif isinstance(value, Int):
+        buf.append(TAG_INT)
+        write_word(buf, r_ulonglong(value.int_val))
+    elif isinstance(value, Float):
+        buf.append(TAG_FLOAT)
+        write_word(buf, float_pack(value.float_val, 8))
+    elif isinstance(value, Str):
+        buf.append(TAG_STR)
+        write_str(buf, value.str_val)
+    elif isinstance(value, Array):
+        items = value.array_val
+        buf.append(TAG_ARRAY)
+        write_length(buf, len(items))
+        for item in items:
+            write_value(buf, item)
+    elif isinstance(value, Object):
+        items = value.items()
+        buf.append(TAG_OBJECT)
+        write_length(buf, len(items))
+        for key, item in items:
+            write_str(buf, key)
+            write_value(buf, item)
+    else:
+        raise Exception('unknown data type.')
+
+def write_word(buf, word):
+    for shift in range(56, -8, -8):
+        buf.append(chr(intmask((word >> shift) & 0xff)))
+
+def write_length(buf, length):
+    for shift in range(24, -8, -8):
+        buf.append(chr((length >> shift) & 0xff))
+
+def write_str(buf, s):
+    write_length(buf, len(s))
+    buf.append(s)
+
+
+class ValueReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read_bytes(self, n):
+        start = self.pos
+        end = start + n
+        if n < 0 or end > len(self.data):
+            raise ValueError('truncated value')
+        assert start >= 0 and end >= 0
+        self.pos = end
+        return self.data[start:end]
+
+    def read_word(self):
+        word = r_ulonglong(0)
+        for c in self.read_bytes(8):
+            word = (word << 8) | r_ulonglong(ord(c))
+        return word
+
+    def read_length(self):
+        length = 0
+        for c in self.read_bytes(4):
+            length = (length << 8) | ord(c)
+        return length
+
+    def read_value(self):
+        tag = self.read_bytes(1)
+        if tag == TAG_NULL:
+            return null
+        elif tag == TAG_TRUE:
+            return true
+        elif tag == TAG_FALSE:
+            return false
+        elif tag == TAG_INT:
+            return newint(intmask(self.read_word()))
+        elif tag == TAG_FLOAT:
+            return Float(float_unpack(self.read_word(), 8))
+        elif tag == TAG_STR:
+            return Str(self.read_bytes(self.read_length()))
+        elif tag == TAG_ARRAY:
+            length = self.read_length()
+            return Array([self.read_value() for _ in range(length)])
+        elif tag == TAG_OBJECT:
+            _object = Object({})
+            for _ in range(self.read_length()):
+                key = self.read_bytes(self.read_length())
+                _object.setfield(key, self.read_value())
+            return _object
+        else:
+            raise ValueError('unknown value tag')
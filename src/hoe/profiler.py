@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from rpython.rlib.rfloat import formatd
+
+KIND_PROC = 'proc'
+KIND_BUILTIN = 'builtin'
+
+
+class ProfileEntry(object):
+    """Totals of one proc or builtin. Times are in seconds; cumulative
+    time counts only the outermost of recursive calls."""
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.calls = 0
+        self.self_time = 0.0
+        self.cum_time = 0.0
+        self.active = 0
+
+
+class ProfileCall(object):
+    def __init__(self, entry, start):
+        self.entry = entry
+        self.start = start
+        self.child_time = 0.0
+
+
+class Profiler(object):
+    """Deterministic profiler, fed by the interpreter on every proc and
+    builtin call while it is installed as `engine.profiler`."""
+
+    def __init__(self):
+        self.entries = {}
+        self.calls = []
+
+    def get_entry(self, kind, name):
+        key = '%s:%s' % (kind, name)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            entry = ProfileEntry(kind, name)
+            self.entries[key] = entry
+        return entry
+
+    def enter(self, kind, name):
+        entry = self.get_entry(kind, name)
+        entry.calls += 1
+        entry.active += 1
+        self.calls.append(ProfileCall(entry, time.time()))
+
+    def exit(self):
+        if not self.calls:
+            return
+        call = self.calls.pop()
+        elapsed = time.time() - call.start
+        entry = call.entry
+        entry.self_time += elapsed - call.child_time
+        entry.active -= 1
+        if entry.active == 0:
+            entry.cum_time += elapsed
+        if self.calls:
+            self.calls[len(self.calls) - 1].child_time += elapsed
+
+    def finish(self):
+        """Close the calls left open, e.g. by an error."""
+        while self.calls:
+            self.exit()
+
+    def sorted_entries(self):
+        entries = self.entries.values()
+        # insertion sort by descending cumulative time; reports are small
+        for i in range(1, len(entries)):
+            entry = entries[i]
+            j = i - 1
+            while j >= 0 and entries[j].cum_time < entry.cum_time:
+                entries[j + 1] = entries[j]
+                j -= 1
+            entries[j + 1] = entry
+        return entries
+
+    def report_text(self):
+        lines = [format_row('calls', 'self(ms)', 'cum(ms)', 'kind', 'name')]
+        for entry in self.sorted_entries():
+            lines.append(format_row('%d' % entry.calls,
+                                    format_ms(entry.self_time),
+                                    format_ms(entry.cum_time),
+                                    entry.kind, entry.name))
+        return '\n'.join(lines) + '\n'
+
+    def report_json(self):
+        items = []
+        for entry in self.sorted_entries():
+            items.append('{"kind": "%s", "name": "%s", "calls": %d, '
+                         '"self": %s, "cum": %s}' % (
+                             entry.kind, json_escape(entry.name), entry.calls,
+                             repr_float(entry.self_time),
+                             repr_float(entry.cum_time)))
+        return '[\n%s\n]\n' % ',\n'.join(items)
+
+
+def format_row(calls, self_time, cum_time, kind, name):
+    return '%s %s %s  %s %s' % (rjust(calls, 8), rjust(self_time, 12),
+                                rjust(cum_time, 12), ljust(kind, 8), name)
+
+def rjust(text, width):
+    return ' ' * max(width - len(text), 0) + text
+
+def ljust(text, width):
+    return text + ' ' * max(width - len(text), 0)
+
+def format_ms(seconds):
+    return formatd(seconds * 1000.0, 'f', 3)
+
+def repr_float(value):
+    return formatd(value, 'f', 9)
+
+HEX_DIGITS = '0123456789abcdef'
+
+def json_escape(text):
+    chars = []
+    for c in text:
+        if c == '"' or c == '\\':
+            chars.append('\\')
+            chars.append(c)
+        elif ord(c) < 0x20:
+            chars.append('\\u00')
+            chars.append(HEX_DIGITS[ord(c) >> 4])
+            chars.append(HEX_DIGITS[ord(c) & 15])
+        else:
+            chars.append(c)
+    return ''.join(chars)
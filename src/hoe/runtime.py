@@ -1,72 +1,503 @@
 # -*- coding: utf-8 -*-
 
-class Type(object): pass
+from rpython.rlib import jit
+from rpython.rlib.rerased import new_erasing_pair
+
+class Type(object):
+    def dump(self, out):
+        """Write the printed form of the value to the file `out`."""
+        out.write(self.__str__())
 
 class Int(Type):
+    _immutable_fields_ = ['int_val']
     def __init__(self, int_val):
         self.int_val = int_val
     def __str__(self):
         return '%d' % self.int_val
 
 class Float(Type):
+    _immutable_fields_ = ['float_val']
     def __init__(self, float_val):
         self.float_val = float_val
     def __str__(self):
         return '%f' % self.float_val
 
 class Str(Type):
+    """A string, or a lazy rope of two strings built by `concat`.
+
+    A rope is flattened the first time its characters are read through
+    `str_val`, so building a string piece by piece stays linear.
+    """
+    _immutable_fields_ = ['size']
     def __init__(self, str_val):
-        self.str_val = str_val
+        self.flat = str_val
+        self.left = None
+        self.right = None
+        self.size = len(str_val)
+    def length(self):
+        return self.size
+    def is_flat(self):
+        return self.flat is not None
+    def flatten(self):
+        pieces = []
+        todo = [self]
+        while todo:
+            node = todo.pop()
+            if node.flat is not None:
+                pieces.append(node.flat)
+            else:
+                todo.append(node.right)
+                todo.append(node.left)
+        self.flat = ''.join(pieces)
+        self.left = None
+        self.right = None
+    def _get_str_val(self):
+        if self.flat is None:
+            self.flatten()
+        flat = self.flat
+        assert flat is not None
+        return flat
+    str_val = property(_get_str_val)
+    def dump(self, out):
+        out.write('"')
+        if self.flat is not None:
+            out.write(self.flat)
+        else:
+            todo = [self]
+            while todo:
+                node = todo.pop()
+                if node.flat is not None:
+                    out.write(node.flat)
+                else:
+                    todo.append(node.right)
+                    todo.append(node.left)
+        out.write('"')
     def __str__(self):
         return '"%s"' % self.str_val
 
+# Concatenations shorter than this are copied right away.
+ROPE_MIN = 64
+
+def concat(left, right):
+    """Return `left + right`, deferring the copy for long strings."""
+    if left.size == 0:
+        return right
+    elif right.size == 0:
+        return left
+    elif left.size + right.size < ROPE_MIN:
+        return Str(left.str_val + right.str_val)
+    rope = Str('')
+    rope.flat = None
+    rope.left = left
+    rope.right = right
+    rope.size = left.size + right.size
+    return rope
+
 class Null(Type):
     def __str__(self):
         return 'null'
 
 class Bool(Type):
+    _immutable_fields_ = ['bool_val']
     def __init__(self, bool_val):
         self.bool_val = bool_val
     def __str__(self):
         return 'true' if self.bool_val else 'false'
 
 class Array(Type):
+    """An array whose elements are kept by an ArrayStrategy.
+
+    Arrays of only ints or only floats store the raw numbers, and switch
+    to boxed storage when a different value is appended.
+    """
     def __init__(self, array_val):
-        self.array_val = array_val
+        self.strategy = strategy_for(array_val)
+        self.storage = self.strategy.store(array_val)
+    def length(self):
+        return jit.promote(self.strategy).length(self)
+    def getitem(self, index):
+        return jit.promote(self.strategy).getitem(self, index)
+    def append(self, value):
+        jit.promote(self.strategy).append(self, value)
+    def int_storage(self):
+        """The raw ints of an int array, or None."""
+        if self.strategy is int_strategy:
+            return int_strategy.unerase(self.storage)
+        return None
+    def float_storage(self):
+        """The raw floats of a float array, or None."""
+        if self.strategy is float_strategy:
+            return float_strategy.unerase(self.storage)
+        return None
+    def _get_array_val(self):
+        return jit.promote(self.strategy).items(self)
+    array_val = property(_get_array_val)
+    def dump(self, out):
+        out.write('[')
+        for i in range(self.length()):
+            if i > 0:
+                out.write(', ')
+            self.getitem(i).dump(out)
+        out.write(']')
     def __str__(self):
         return '[%s]' % (', '.join([x.__str__() for x in self.array_val]))
 
+class ArrayStrategy(object):
+    def store(self, array_val):
+        raise NotImplementedError
+    def length(self, array):
+        raise NotImplementedError
+    def getitem(self, array, index):
+        raise NotImplementedError
+    def append(self, array, value):
+        raise NotImplementedError
+    def items(self, array):
+        raise NotImplementedError
+    def switch_to_object(self, array):
+        items = self.items(array)
+        array.strategy = object_strategy
+        array.storage = object_strategy.erase(items)
+
+class EmptyArrayStrategy(ArrayStrategy):
+    erase, unerase = new_erasing_pair('empty')
+    erase = staticmethod(erase)
+    unerase = staticmethod(unerase)
+    def store(self, array_val):
+        return self.erase(None)
+    def length(self, array):
+        return 0
+    def getitem(self, array, index):
+        raise IndexError
+    def append(self, array, value):
+        strategy = strategy_for([value])
+        array.strategy = strategy
+        array.storage = strategy.store([value])
+    def items(self, array):
+        return []
+
+class ObjectArrayStrategy(ArrayStrategy):
+    erase, unerase = new_erasing_pair('object')
+    erase = staticmethod(erase)
+    unerase = staticmethod(unerase)
+    def store(self, array_val):
+        return self.erase(array_val[:])
+    def length(self, array):
+        return len(self.unerase(array.storage))
+    def getitem(self, array, index):
+        return self.unerase(array.storage)[index]
+    def append(self, array, value):
+        self.unerase(array.storage).append(value)
+    def items(self, array):
+        return self.unerase(array.storage)[:]
+
+class IntArrayStrategy(ArrayStrategy):
+    erase, unerase = new_erasing_pair('int')
+    erase = staticmethod(erase)
+    unerase = staticmethod(unerase)
+    def store(self, array_val):
+        ints = []
+        for el in array_val:
+            assert isinstance(el, Int)
+            ints.append(el.int_val)
+        return self.erase(ints)
+    def length(self, array):
+        return len(self.unerase(array.storage))
+    def getitem(self, array, index):
+        return newint(self.unerase(array.storage)[index])
+    def append(self, array, value):
+        if isinstance(value, Int):
+            self.unerase(array.storage).append(value.int_val)
+        else:
+            self.switch_to_object(array)
+            array.append(value)
+    def items(self, array):
+        return [newint(i) for i in self.unerase(array.storage)]
+
+class FloatArrayStrategy(ArrayStrategy):
+    erase, unerase = new_erasing_pair('float')
+    erase = staticmethod(erase)
+    unerase = staticmethod(unerase)
+    def store(self, array_val):
+        floats = []
+        for el in array_val:
+            assert isinstance(el, Float)
+            floats.append(el.float_val)
+        return self.erase(floats)
+    def length(self, array):
+        return len(self.unerase(array.storage))
+    def getitem(self, array, index):
+        return Float(self.unerase(array.storage)[index])
+    def append(self, array, value):
+        if isinstance(value, Float):
+            self.unerase(array.storage).append(value.float_val)
+        else:
+            self.switch_to_object(array)
+            array.append(value)
+    def items(self, array):
+        return [Float(f) for f in self.unerase(array.storage)]
+
+empty_strategy = EmptyArrayStrategy()
+object_strategy = ObjectArrayStrategy()
+int_strategy = IntArrayStrategy()
+float_strategy = FloatArrayStrategy()
+
+def strategy_for(array_val):
+    if len(array_val) == 0:
+        return empty_strategy
+    all_ints = True
+    all_floats = True
+    for el in array_val:
+        if not isinstance(el, Int):
+            all_ints = False
+        if not isinstance(el, Float):
+            all_floats = False
+    if all_ints:
+        return int_strategy
+    elif all_floats:
+        return float_strategy
+    else:
+        return object_strategy
+
+MAX_SHAPE_KEYS = 64
+
+class Shape(object):
+    """The ordered keys of an object, shared by objects built alike."""
+    _immutable_fields_ = ['keys[*]', 'indexes']
+    def __init__(self, keys):
+        self.keys = keys
+        self.indexes = {}
+        for i in range(len(keys)):
+            self.indexes[keys[i]] = i
+        self.transitions = {}
+    @jit.elidable
+    def lookup(self, key):
+        return self.indexes.get(key, -1)
+    @jit.elidable
+    def with_key(self, key):
+        shape = self.transitions.get(key, None)
+        if shape is None:
+            shape = Shape(self.keys + [key])
+            self.transitions[key] = shape
+        return shape
+
+root_shape = Shape([])
+
 class Object(Type):
+    """An object whose keys are described by a shared Shape.
+
+    Field values live in a list indexed through the shape. Objects with
+    more than MAX_SHAPE_KEYS keys fall back to a plain dict.
+    """
     def __init__(self, object_val):
-        self.object_val = object_val
+        self.shape = root_shape
+        self.fields = []
+        self.dict_val = None
+        for key, value in object_val.items():
+            self.setfield(key, value)
+    def getfield(self, key):
+        """The value of `key`, or None."""
+        if self.shape is None:
+            return self.dict_val.get(key, None)
+        index = jit.promote(self.shape).lookup(key)
+        if index < 0:
+            return None
+        return self.fields[index]
+    def setfield(self, key, value):
+        if self.shape is None:
+            self.dict_val[key] = value
+            return
+        index = self.shape.lookup(key)
+        if index >= 0:
+            self.fields[index] = value
+        elif len(self.shape.keys) >= MAX_SHAPE_KEYS:
+            self.dict_val = self._get_object_val()
+            self.dict_val[key] = value
+            self.shape = None
+            self.fields = []
+        else:
+            self.shape = self.shape.with_key(key)
+            self.fields.append(value)
+    def length(self):
+        if self.shape is None:
+            return len(self.dict_val)
+        return len(self.fields)
+    def items(self):
+        if self.shape is None:
+            return self.dict_val.items()
+        items = []
+        for i in range(len(self.fields)):
+            items.append((self.shape.keys[i], self.fields[i]))
+        return items
+    def _get_object_val(self):
+        object_val = {}
+        for key, value in self.items():
+            object_val[key] = value
+        return object_val
+    object_val = property(_get_object_val)
+    def dump(self, out):
+        out.write('{')
+        first = True
+        for key, value in self.items():
+            if not first:
+                out.write(', ')
+            first = False
+            out.write(key)
+            out.write(': ')
+            value.dump(out)
+        out.write('}')
+    def __str__(self):
+        return '{%s}' % (', '.join(['%s: %s' % (k, v.__str__()) for k, v in self.items()]))
+
+class Seq(Type):
+    """A lazy sequence, consumed one element at a time through a Cursor."""
+    def cursor(self):
+        raise NotImplementedError
+    def length(self):
+        count = 0
+        cursor = self.cursor()
+        while cursor.next() is not None:
+            count += 1
+        return count
+    def dump(self, out):
+        out.write('[')
+        cursor = self.cursor()
+        el = cursor.next()
+        while el is not None:
+            el.dump(out)
+            el = cursor.next()
+            if el is not None:
+                out.write(', ')
+        out.write(']')
     def __str__(self):
-        return '{%s}' % (', '.join(['%s: %s' % (k, v.__str__()) for k, v in self.object_val.items()]))
+        items = []
+        cursor = self.cursor()
+        el = cursor.next()
+        while el is not None:
+            items.append(el.__str__())
+            el = cursor.next()
+        return '[%s]' % (', '.join(items))
+
+class Cursor(object):
+    def next(self):
+        """Return the next element, or None once exhausted."""
+        raise NotImplementedError
+
+class Range(Seq):
+    _immutable_fields_ = ['start', 'stop', 'step']
+    def __init__(self, start, stop, step):
+        if step == 0:
+            raise Exception('range step must not be zero.')
+        self.start = start
+        self.stop = stop
+        self.step = step
+    def cursor(self):
+        return RangeCursor(self.start, self.stop, self.step)
+    def length(self):
+        if self.step > 0 and self.stop > self.start:
+            return (self.stop - self.start + self.step - 1) / self.step
+        elif self.step < 0 and self.start > self.stop:
+            return (self.start - self.stop - self.step - 1) / (0 - self.step)
+        else:
+            return 0
+
+class RangeCursor(Cursor):
+    def __init__(self, start, stop, step):
+        self.current = start
+        self.stop = stop
+        self.step = step
+    def next(self):
+        if self.step > 0 and self.current >= self.stop:
+            return None
+        elif self.step < 0 and self.current <= self.stop:
+            return None
+        value = newint(self.current)
+        self.current += self.step
+        return value
 
 null = Null()
 true = Bool(True)
 false = Bool(False)
 
+SMALL_INT_MIN = -5
+SMALL_INT_MAX = 256
+small_ints = [Int(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+def newint(int_val):
+    """Return an Int, sharing the prebuilt ones for small values."""
+    if int_val >= SMALL_INT_MIN and int_val <= SMALL_INT_MAX:
+        return small_ints[int_val - SMALL_INT_MIN]
+    return Int(int_val)
+
+class Scope(object):
+    """Static label layout of a code object.
+
+    The compiler gives every label of a script, module, proc or begin
+    block a fixed slot. Slot 0 always holds `^`.
+    """
+    _immutable_fields_ = ['labels[*]', 'indexes']
+    def __init__(self, labels):
+        self.labels = labels
+        self.indexes = {}
+        for i in range(len(labels)):
+            self.indexes[labels[i]] = i
+    @jit.elidable
+    def lookup(self, key):
+        return self.indexes.get(key, -1)
+
+empty_scope = Scope(['^'])
+
 class Env(object):
-    def __init__(self):
-        self.identifier = '^'
-        self.namespace = {}
+    def __init__(self, scope=empty_scope):
+        self.scope = scope
+        self.slots = [None] * len(scope.labels)
+        self.namespace = {} # labels outside of the scope, e.g. imported ones.
         self.defs = {}
+        self.has_payload = False
+        self.payload = null
     def has(self, key):
+        index = self.scope.lookup(key)
+        if index >= 0:
+            return self.slots[index] is not None
         return key in self.namespace
     def get(self, key):
-        if key in self.namespace:
+        index = self.scope.lookup(key)
+        if index >= 0 and self.slots[index] is not None:
+            return self.slots[index]
+        elif index < 0 and key in self.namespace:
             return self.namespace[key]
         else:
             raise Exception('undefined label: %s' % key)
     def set(self, key, value):
-        self.namespace[key] = value
-    def push(self, value):
-        if self.identifier != '^':
-            self.set(self.identifier, value)
-        self.set('^', value)
-        self.identifier = '^'
+        index = self.scope.lookup(key)
+        if index >= 0:
+            self.slots[index] = value
+        else:
+            self.namespace[key] = value
+    def set_payload(self, payload):
+        self.has_payload = True
+        self.payload = payload
+    def items(self):
+        items = []
+        for i in range(1, len(self.slots)):
+            if self.slots[i] is not None:
+                items.append((self.scope.labels[i], self.slots[i]))
+        for key, value in self.namespace.items():
+            items.append((key, value))
+        return items
+    def adopt(self, scope):
+        """Switch to the slot layout of `scope`, keeping current labels."""
+        if self.scope is scope:
+            return
+        present = self.slots[0]
+        items = self.items()
+        self.scope = scope
+        self.slots = [None] * len(scope.labels)
+        self.namespace = {}
+        self.slots[0] = present
+        for key, value in items:
+            self.set(key, value)
     def present(self):
-        return self.get(self.identifier) if self.has(self.identifier) else null
+        return self.slots[0] if self.slots[0] is not None else null
     def define_proc(self, def_name, statements):
         self.defs[def_name] = statements
     def has_proc(self, def_name):
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from rpython.rlib import rsignal
+from rpython.rtyper.lltypesystem import lltype, rffi
+
+from hoe.bytecode import STORE, STORE_LOOP
+
+DEFAULT_INTERVAL = 1000 # microseconds of cpu time between samples
+
+
+class Sampler(object):
+    """Sampling profiler driven by a SIGPROF interval timer.
+
+    The signal handler only raises a flag. The interpreter checks it
+    between instructions while the sampler is installed as
+    `engine.sampler`, and then records the hoe stack: the code of every
+    frame on `engine.frames` with the label of the statement it runs.
+    Frames replaced by a tail call are gone and do not show up.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = {}
+        self.stacks = [] # in the order they were first seen
+        self.samples = 0
+        self.occurred = rsignal.pypysig_getaddr_occurred()
+
+    def start(self):
+        rsignal.pypysig_setflag(rsignal.SIGPROF)
+        # restart system calls interrupted by a sample
+        rsignal.c_siginterrupt(rsignal.SIGPROF, 0)
+        set_timer(self.interval)
+
+    def stop(self):
+        set_timer(0)
+        rsignal.pypysig_default(rsignal.SIGPROF)
+        self.reset()
+
+    def reset(self):
+        self.occurred.c_value = 0
+        while rsignal.pypysig_poll() >= 0:
+            pass
+
+    def poll(self, engine, pc):
+        """Take a sample if the timer fired. `pc` is the position of the
+        running frame, which is only saved in the frame when it calls."""
+        if self.occurred.c_value < 0:
+            self.reset()
+            self.sample(engine, pc)
+
+    def sample(self, engine, pc):
+        parts = []
+        top = len(engine.frames) - 1
+        for i in range(len(engine.frames)):
+            frame = engine.frames[i]
+            parts.append(frame_name(frame.code, pc if i == top else frame.pc))
+        key = ';'.join(parts)
+        count = self.counts.get(key, 0)
+        if count == 0:
+            self.stacks.append(key)
+        self.counts[key] = count + 1
+        self.samples += 1
+
+    def report_collapsed(self):
+        """One `frame;frame;... count` line per distinct stack, the
+        input format of flame graph tools."""
+        lines = []
+        for key in self.stacks:
+            lines.append('%s %d\n' % (key, self.counts[key]))
+        return ''.join(lines)
+
+
+def frame_name(code, pc):
+    label = statement_label(code, pc)
+    if label == '^':
+        return code.name
+    return '%s:%s' % (code.name, label)
+
+def statement_label(code, pc):
+    """Every statement ends storing its result, so the next STORE from
+    `pc` on names the label of the running statement."""
+    instructions = code.instructions
+    while pc < len(instructions):
+        if instructions[pc] == STORE or instructions[pc] == STORE_LOOP:
+            return code.scope.labels[instructions[pc + 1]]
+        pc += 2
+    return '^'
+
+def set_timer(interval):
+    """Fire SIGPROF every `interval` microseconds of cpu time, or stop
+    the timer if it is 0."""
+    value = lltype.malloc(rsignal.itimervalP.TO, 1, flavor='raw')
+    try:
+        for timeval in [value[0].c_it_value, value[0].c_it_interval]:
+            timeval.c_tv_sec = rffi.cast(rffi.LONG, interval / 1000000)
+            timeval.c_tv_usec = rffi.cast(rffi.LONG, interval % 1000000)
+        rsignal.c_setitimer(rsignal.ITIMER_PROF, value,
+                            lltype.nullptr(rsignal.itimervalP.TO))
+    finally:
+        lltype.free(value, flavor='raw')
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+from hoe.runtime import Type, null
+
+
+class Task(Type):
+    """A green thread: its own env stack and heap frames.
+
+    A task only gives up control at a `task.yield`, or when it blocks on
+    a channel or on `task.join`, and is resumed with `resume_value` as the
+    result of that builtin.
+    """
+
+    def __init__(self, id, stack, frames):
+        self.id = id
+        self.stack = stack
+        self.frames = frames
+        self.done = False
+        self.result = null
+        self.resume_value = None
+        self.joiners = []
+
+    def __str__(self):
+        return '<task %d>' % self.id
+
+
+class SendWaiter(object):
+    def __init__(self, task, value):
+        self.task = task
+        self.value = value
+
+
+class Channel(Type):
+    """A FIFO channel between tasks. A channel of capacity 0 hands every
+    value from a sender directly to a receiver."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = []
+        self.receivers = []
+        self.senders = []
+
+    def take(self, scheduler):
+        """Return the next value, or None if a receiver has to wait."""
+        if self.items:
+            value = self.items.pop(0)
+            if self.senders:
+                waiter = self.senders.pop(0)
+                self.items.append(waiter.value)
+                scheduler.wake(waiter.task, null)
+            return value
+        elif self.senders:
+            waiter = self.senders.pop(0)
+            scheduler.wake(waiter.task, null)
+            return waiter.value
+        return None
+
+    def give(self, scheduler, value):
+        """Pass `value` on. Returns False if the sender has to wait."""
+        if self.receivers:
+            scheduler.wake(self.receivers.pop(0), value)
+            return True
+        elif len(self.items) < self.capacity:
+            self.items.append(value)
+            return True
+        return False
+
+    def __str__(self):
+        return '<channel %d/%d>' % (len(self.items), self.capacity)
+
+
+class Scheduler(object):
+    """Round-robin scheduler of the tasks of an engine.
+
+    Tasks run one at a time on the engine, by swapping their env stack
+    and frames in. The main script is not a task: when it would block,
+    it runs ready tasks until it can go on.
+    """
+
+    def __init__(self):
+        self.ready = []
+        self.current = None
+        self.switching = False
+        self.next_id = 1
+
+    def new_task(self, stack, frames):
+        task = Task(self.next_id, stack, frames)
+        self.next_id += 1
+        self.ready.append(task)
+        return task
+
+    def wake(self, task, value):
+        task.resume_value = value
+        self.ready.append(task)
+
+    def block(self):
+        """Suspend the current task once the running builtin returns."""
+        self.switching = True
+
+    def run_once(self, engine):
+        """Run the next ready task until it blocks, yields or finishes.
+        Returns False if no task is ready."""
+        if not self.ready:
+            return False
+        task = self.ready.pop(0)
+        self.run_task(engine, task)
+        return True
+
+    def run_task(self, engine, task):
+        stack = engine.stack
+        frames = engine.frames
+        previous = self.current
+        engine.stack = task.stack
+        engine.frames = task.frames
+        self.current = task
+        # Visible procs depend on the env stack.
+        engine.invalidate_procs()
+        try:
+            if task.resume_value is not None:
+                top = task.frames[len(task.frames) - 1]
+                top.stack.append(task.resume_value)
+                task.resume_value = None
+            result = engine.resume()
+        finally:
+            engine.stack = stack
+            engine.frames = frames
+            self.current = previous
+            engine.invalidate_procs()
+        if result is not None:
+            task.done = True
+            task.result = result
+            for joiner in task.joiners:
+                self.wake(joiner, result)
+            task.joiners = []
+
+    def run_all(self, engine):
+        while self.run_once(engine):
+            pass
+
+    def yield_(self, engine):
+        task = self.current
+        if task is not None:
+            self.wake(task, null)
+            self.block()
+            return
+        for i in range(len(self.ready)):
+            self.run_once(engine)
+
+    def join(self, engine, task):
+        if task.done:
+            return task.result
+        current = self.current
+        if current is not None:
+            if current is task:
+                raise Exception('a task cannot join itself.')
+            task.joiners.append(current)
+            self.block()
+            return null
+        while not task.done:
+            if not self.run_once(engine):
+                raise Exception('deadlock: %s never finishes.' % task.__str__())
+        return task.result
+
+    def send(self, engine, channel, value):
+        if channel.give(self, value):
+            return
+        current = self.current
+        if current is not None:
+            channel.senders.append(SendWaiter(current, value))
+            self.block()
+            return
+        while not channel.give(self, value):
+            if not self.run_once(engine):
+                raise Exception('deadlock: nobody receives from %s.' % channel.__str__())
+
+    def recv(self, engine, channel):
+        value = channel.take(self)
+        if value is not None:
+            return value
+        current = self.current
+        if current is not None:
+            channel.receivers.append(current)
+            self.block()
+            return null
+        while True:
+            if not self.run_once(engine):
+                raise Exception('deadlock: nobody sends to %s.' % channel.__str__())
+            value = channel.take(self)
+            if value is not None:
+                return value
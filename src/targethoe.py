@@ -4,10 +4,56 @@ import sys
 from rpython.jit.codewriter.policy import JitPolicy
 
 from hoe.engine import Engine
+from hoe.pmap import write_all
+from hoe.sampler import DEFAULT_INTERVAL
+
+USAGE = ('usage: hoe [--line-buffered] [--profile] '
+         '[--sample[=microseconds]] script.ho')
 
 def main(argv):
     engine = Engine(argv[0])
-    return engine.run_script(argv[1])
+    i = 1
+    while i < len(argv) and argv[i].startswith('--'):
+        if argv[i] == '--line-buffered':
+            engine.stdout.line_buffered = True
+        elif argv[i] == '--profile':
+            engine.start_profiling()
+        elif argv[i] == '--sample':
+            engine.start_sampling(DEFAULT_INTERVAL)
+        elif argv[i].startswith('--sample='):
+            try:
+                interval = int(argv[i][len('--sample='):])
+            except ValueError:
+                interval = 0
+            if interval <= 0:
+                print USAGE
+                return 1
+            engine.start_sampling(interval)
+        else:
+            print USAGE
+            return 1
+        i += 1
+    if i >= len(argv):
+        print USAGE
+        return 1
+    if engine.profiler is None and engine.sampler is None:
+        return engine.run_script(argv[i])
+    status = engine.run_script(argv[i])
+    if engine.profiler is not None:
+        profiler = engine.stop_profiling()
+        write_all(2, profiler.report_text())
+        write_file(argv[i] + '.profile.json', profiler.report_json())
+    if engine.sampler is not None:
+        sampler = engine.stop_sampling()
+        write_file(argv[i] + '.folded', sampler.report_collapsed())
+    return status
+
+def write_file(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        write_all(fd, data)
+    finally:
+        os.close(fd)
 
 def target(driver, args):
     driver.exe_name = 'hoe'
@@ -17,4 +63,4 @@ def jitpolicy(driver):
     return JitPolicy()
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
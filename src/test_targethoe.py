@@ -4,11 +4,12 @@ import pytest
 
 from hoe.engine import Engine
 from hoe.runtime import Env
-from hoe.interpreter import eval_source_code
+from hoe.interpreter import eval_source_code, eval_code, eval_module_code
+from hoe.compiler import compile_source
 from hoe.runtime import (Env, Type, Int, Float,
                          Str, Bool, Null, Array,
                          Object,
-                         null, true, false)
+                         null, true, false, newint)
 
 
 @pytest.fixture
@@ -218,6 +219,67 @@ def test_iter_array(engine):
     assert isinstance(val, Int)
     assert val.int_val == 6 # 0 + 1 + 2 + 3
 
+def test_iter_label_after_loop(engine):
+    val = eval_source_code(engine, """
+        a: iter [1, 2, 3]
+            y: value a
+        end
+        s: iter "abc"
+            y: value s
+        end
+        n: iter 3
+            y: value n
+        end
+        e: iter [1, 2]
+        end
+        last: iter [4, 5]
+            y: value last
+        end
+        none: iter []
+            y: value 1
+        end
+        blank: iter ""
+            y: value 1
+        end
+        zero: iter 0
+            y: value 1
+        end
+        branch: cond
+            value true
+                iter [1, 2]
+                    y: value 1
+                end
+        end
+        empty_branch: cond
+            value true
+                iter []
+                    y: value 1
+                end
+        end
+        value [a, s, n, e, last, none, blank, zero, branch, empty_branch]
+    """)
+    a, s, n, e, last, none, blank, zero, branch, empty_branch = val.array_val
+    assert a.int_val == 3
+    assert s.str_val == 'c'
+    assert n.int_val == 3
+    assert e.__str__() == '[1, 2]'
+    assert last.int_val == 5
+    assert none.__str__() == '[]'
+    assert blank.str_val == ''
+    assert zero.int_val == 0
+    assert branch.int_val == 2
+    assert empty_branch.__str__() == '[]'
+    assert eval_source_code(engine, 'iter [6, 7] y: value 1 end').__str__() == '[6, 7]'
+    val = eval_source_code(engine, """
+        outer: iter [1, 2]
+            inner: iter [3, 4]
+                y: value 1
+            end
+        end
+        value [outer, inner]
+    """)
+    assert val.__str__() == '[2, 4]'
+
 def test_fib(engine):
     val = eval_source_code(engine, """
         proc "fib"
@@ -397,3 +459,1097 @@ def test_builtin_filter(engine):
     """)
     vals = [el.int_val for el in val.array_val]
     assert vals == [0, 0]
+
+def test_recursive_proc(engine):
+    val = eval_source_code(engine, """
+        proc "fib"
+            cond
+                eval "=" [$, 0]
+                    value 0
+                eval "=" [$, 1]
+                    value 1
+                value true
+                    begin
+                        a: eval "-" [$, 1]
+                        b: eval "fib" a
+                        c: eval "-" [$, 2]
+                        d: eval "fib" c
+                        eval "+" [b, d]
+                    end
+            end
+        end
+        eval "fib" 10
+    """)
+    assert val.int_val == 55
+
+def test_nested_iter(engine):
+    val = eval_source_code(engine, """
+        sum: value 0
+        i: iter 3
+            j: iter [10, 20]
+                sum: eval "+" [sum, i, j]
+            end
+        end
+        value sum
+    """)
+    assert val.int_val == 3 * 30 + 2 * 3
+
+def test_compiled_code_runs_repeatedly(engine):
+    code = compile_source("""
+        x: iter 4
+            y: eval "*" [x, 2]
+        end
+        value y
+    """)
+    assert eval_code(engine, code).int_val == 6
+    assert eval_code(engine, code).int_val == 6
+
+def test_builtin_map_with_builtin_callback(engine):
+    val = eval_source_code(engine, """
+        eval "map" ["len", [[1], [1, 2], "abc", {"key": 1.5}]]
+    """)
+    assert [el.int_val for el in val.array_val] == [1, 2, 3, 1]
+
+def test_builtin_filter_keeps_structured_values(engine):
+    val = eval_source_code(engine, """
+        proc "big?" eval "=" [$["size"], 2] end
+        eval "filter" ["big?", [{"size": 1}, {"size": 2, "tag": "x"}]]
+    """)
+    assert len(val.array_val) == 1
+    assert val.array_val[0].object_val["tag"].str_val == "x"
+
+@pytest.fixture
+def pkg_engine(tmpdir):
+    tmpdir.mkdir('pkg')
+    return Engine(str(tmpdir.join('bin', 'hoe')))
+
+def test_builtin_import(pkg_engine, tmpdir):
+    tmpdir.join('pkg', 'mod.ho').write("""
+        answer: value 42
+        proc "double" eval "*" [$, 2] end
+    """)
+    val = eval_source_code(pkg_engine, """
+        eval "import" "mod"
+        eval "double" answer
+    """)
+    assert val.int_val == 84
+    assert tmpdir.join('pkg', 'mod.hoc').check()
+
+def test_module_cache_skips_parser(tmpdir, monkeypatch):
+    from hoe import codecache
+    path = tmpdir.join('mod.ho')
+    path.write('x: value [1, 2.5, "s", {"k": null}, true, false]')
+    codecache.load_module_code(str(path))
+    def fail(*args):
+        raise AssertionError('parser should not run')
+    monkeypatch.setattr(codecache, 'compile_source', fail)
+    code = codecache.load_module_code(str(path))
+    env = eval_module_code(Engine('hoe'), code)
+    x = env.get('x')
+    assert [type(el) for el in x.array_val] == [Int, Float, Str, Object, Bool, Bool]
+    assert x.array_val[3].object_val['k'] is null
+    monkeypatch.undo()
+    path.write('x: value 2')
+    code = codecache.load_module_code(str(path))
+    assert code.consts[0].int_val == 2
+
+def test_module_cache_ignores_corrupt_file(tmpdir):
+    from hoe import codecache
+    path = tmpdir.join('mod.ho')
+    path.write('x: value 1')
+    tmpdir.join('mod.hoc').write('garbage')
+    code = codecache.load_module_code(str(path))
+    assert code.consts[0].int_val == 1
+    data = tmpdir.join('mod.hoc').read('rb')
+    # the length of the first string, the magic, right after the checksum,
+    # the tuple header and the string type code
+    length = codecache.CHECKSUM_SIZE + 6
+    assert data[length - 1:length + 7] == 's\x03\x00\x00\x00hoc'
+    tmpdir.join('mod.hoc').write(data[:length] + '\xff\xff\xff\x7f' +
+                                 data[length + 4:], 'wb')
+    mtime = path.mtime()
+    digest = codecache.source_digest('x: value 1')
+    assert codecache.read_cache(str(tmpdir.join('mod.hoc')), mtime, digest) is None
+    for i in range(len(data)):
+        damaged = data[:i] + chr(ord(data[i]) ^ 0x40) + data[i + 1:]
+        assert codecache.loads(damaged, mtime, digest) is None
+    assert codecache.load_module_code(str(path)).consts[0].int_val == 1
+
+def test_import_evaluates_module_once(pkg_engine, tmpdir):
+    tmpdir.join('pkg', 'mod.ho').write("""
+        proc "inc" eval "+" [$, 1] end
+    """)
+    val = eval_source_code(pkg_engine, """
+        eval "import" "mod"
+        proc "use"
+            eval "import" "mod"
+            eval "inc" $
+        end
+        x: eval "use" 1
+        y: eval "use" x
+        eval "import.stats"
+    """)
+    assert val.object_val['modules'].int_val == 1
+    assert val.object_val['misses'].int_val == 1
+    assert val.object_val['hits'].int_val == 2
+
+def test_constant_literals_are_shared(engine):
+    code = compile_source("""
+        x: iter 2
+            a: value [1, {"k": [2.5, "s"]}]
+            b: eval "+" [x, 1]
+        end
+        value a
+    """)
+    assert [c for c in code.consts if isinstance(c, Array)]
+    first = eval_code(engine, code)
+    assert first.array_val[1].object_val["k"].array_val[1].str_val == "s"
+    assert eval_code(engine, code) is first
+
+def test_small_ints_are_cached(engine):
+    val = eval_source_code(engine, """
+        eval "+" [1, 2]
+    """)
+    assert val is newint(3)
+    assert newint(100000) is not newint(100000)
+
+def test_proc_call_sites_are_cached(engine):
+    val = eval_source_code(engine, """
+        proc "count"
+            cond
+                eval "=" [$, 0]
+                    value 0
+                value true
+                    begin
+                        n: eval "-" [$, 1]
+                        eval "count" n
+                    end
+            end
+        end
+        eval "count" 50
+        eval "proc.stats"
+    """)
+    assert val.object_val['misses'].int_val == 2
+    assert val.object_val['hits'].int_val == 49
+
+def test_proc_cache_follows_stack(engine):
+    val = eval_source_code(engine, """
+        proc "helper" eval "f" $ end
+        proc "a"
+            proc "f" value "a"
+            end
+            eval "helper" $
+        end
+        proc "b"
+            proc "f" value "b"
+            end
+            eval "helper" $
+        end
+        x: eval "a" null
+        y: eval "b" null
+        z: eval "a" null
+        value [x, y, z]
+    """)
+    assert [el.str_val for el in val.array_val] == ["a", "b", "a"]
+    with pytest.raises(Exception):
+        eval_source_code(engine, """
+            proc "helper" eval "f" $ end
+            proc "a"
+                proc "f" value "a" end
+                eval "helper" $
+            end
+            x: eval "a" null
+            eval "helper" null
+        """)
+
+def test_labels_compile_to_slots(engine):
+    code = compile_source("""
+        a: value 1
+        b: iter 2
+            a: eval "+" [a, b]
+        end
+        value a
+    """)
+    assert code.scope.labels == ['^', 'a', 'b']
+    assert eval_code(engine, code).int_val == 2
+
+def test_env_keeps_labels_outside_scope():
+    env = Env()
+    env.set('x', newint(1))
+    env.adopt(compile_source('value x').scope)
+    assert env.slots[1].int_val == 1
+    env.set('y', newint(2))
+    assert env.get('y').int_val == 2
+    assert sorted(key for key, value in env.items()) == ['x', 'y']
+    with pytest.raises(Exception):
+        env.get('z')
+
+def test_deep_recursion_uses_heap_frames(engine):
+    val = eval_source_code(engine, """
+        proc "sum"
+            cond
+                eval "=" [$, 0]
+                    value 0
+                value true
+                    begin
+                        n: eval "-" [$, 1]
+                        rest: eval "sum" n
+                        eval "+" [$, rest]
+                    end
+            end
+        end
+        eval "sum" 5000
+    """)
+    assert val.int_val == 5000 * 5001 / 2
+    assert engine.frames == []
+
+def test_tail_calls_run_in_constant_frames(engine, monkeypatch):
+    from hoe import builtin
+    depths = []
+    def builtin_depth(engine, payload):
+        depths.append(len(engine.frames))
+        return null
+    monkeypatch.setitem(builtin.BUILTINS, 'test.depth', builtin_depth)
+    val = eval_source_code(engine, """
+        proc "loop"
+            eval "test.depth"
+            cond
+                eval "=" [$["n"], 0]
+                    value $["acc"]
+                value true
+                    begin
+                        n: eval "-" [$["n"], 1]
+                        acc: eval "+" [$["acc"], $["n"]]
+                        eval "loop" {"n": n, "acc": acc}
+                    end
+            end
+        end
+        eval "loop" {"n": 300, "acc": 0}
+    """)
+    assert val.int_val == 300 * 301 / 2
+    assert max(depths) == 2
+
+def test_printable_location():
+    from hoe.interpreter import get_printable_location
+    code = compile_source('a: value 1')
+    end = len(code.instructions)
+    assert get_printable_location(0, code).startswith('%s:0 ' % code.name)
+    assert get_printable_location(end, code) == '%s:%d <return>' % (code.name, end)
+
+def test_pure_proc_results_are_cached(engine):
+    val = eval_source_code(engine, """
+        proc "fib"
+            cond
+                eval "=" [$, 0]
+                    value 0
+                eval "=" [$, 1]
+                    value 1
+                value true
+                    begin
+                        a: eval "-" [$, 1]
+                        b: eval "fib" a
+                        c: eval "-" [$, 2]
+                        d: eval "fib" c
+                        eval "+" [b, d]
+                    end
+            end
+        end
+        eval "pure" "fib"
+        x: eval "fib" 60
+        y: eval "fib" 60
+        stats: eval "pure.stats" "fib"
+        value [x, y, stats]
+    """)
+    x, y, stats = val.array_val
+    assert x.int_val == 1548008755920
+    assert y is x
+    assert stats.object_val['misses'].int_val == 61
+    assert stats.object_val['hits'].int_val == 59
+    assert stats.object_val['size'].int_val == 61
+
+def test_pure_proc_cache_is_bounded(engine):
+    val = eval_source_code(engine, """
+        proc "id" value $ end
+        eval "pure" ["id", 2]
+        eval "map" ["id", [[1], [2], [1], [3], [1.0], [1]]]
+        eval "pure.stats" "id"
+    """)
+    stats = dict((k, v.int_val) for k, v in val.object_val.items())
+    assert stats == {'hits': 1, 'misses': 5, 'evictions': 3,
+                     'size': 2, 'limit': 2}
+
+def test_binary_fast_paths_match_builtins(engine):
+    operands = ['1', '2.5', '"a"', '[1, 2]', 'null']
+    for op in ['+', '-', '*', '/', '=']:
+        for left in operands:
+            for right in operands:
+                source = """
+                    l: value %s
+                    r: value %s
+                    args: value [l, r]
+                    eval "%s" %s
+                """
+                results = []
+                for payload in ['[l, r]', 'args']:
+                    try:
+                        val = eval_source_code(Engine('hoe'), source % (left, right, op, payload))
+                        results.append(val.__str__())
+                    except Exception as e:
+                        results.append('error')
+                assert results[0] == results[1], (op, left, right)
+    code = compile_source('a: value 1\neval "+" [a, 1]')
+    assert 'BINARY_ADD' in code.dump()
+    assert 'BUILD_ARRAY' not in code.dump()
+
+def test_array_storage_strategies():
+    from hoe.runtime import int_strategy, float_strategy, object_strategy
+    ints = Array([newint(1), newint(2)])
+    assert ints.strategy is int_strategy
+    assert ints.int_storage() == [1, 2]
+    assert Array([Float(1.0)]).strategy is float_strategy
+    ints.append(Str("x"))
+    assert ints.strategy is object_strategy
+    assert [el.__str__() for el in ints.array_val] == ['1', '2', '"x"']
+    empty = Array([])
+    empty.append(Float(0.5))
+    assert empty.float_storage() == [0.5]
+
+def test_int_array_operations(engine):
+    val = eval_source_code(engine, """
+        proc "double" eval "*" [$, 2] end
+        xs: eval "map" ["double", [1, 2, 3, 4]]
+        total: eval "+" xs
+        size: eval "len" xs
+        third: value xs[2]
+        sum: value 0
+        x: iter xs
+            sum: eval "+" [sum, x]
+        end
+        value [total, size, third, sum, xs]
+    """)
+    total, size, third, sum, xs = val.array_val
+    assert (total.int_val, size.int_val, third.int_val, sum.int_val) == (20, 4, 6, 20)
+    assert xs.int_storage() == [2, 4, 6, 8]
+
+def test_object_shapes(engine):
+    val = eval_source_code(engine, """
+        proc "point"
+            y: eval "*" [$, 2]
+            value {"x": $, "y": y}
+        end
+        points: eval "map" ["point", [1, 2, 3]]
+        ys: value 0
+        p: iter points
+            ys: eval "+" [ys, p["y"]]
+        end
+        value [points, ys]
+    """)
+    points, ys = val.array_val
+    shapes = [p.shape for p in points.array_val]
+    assert shapes[0] is not None
+    assert shapes[0] is shapes[1] is shapes[2]
+    assert shapes[0].keys == ['x', 'y']
+    assert ys.int_val == 12
+
+def test_object_shape_dict_fallback():
+    from hoe.runtime import MAX_SHAPE_KEYS
+    obj = Object({})
+    for i in range(MAX_SHAPE_KEYS + 1):
+        obj.setfield('k%d' % i, newint(i))
+    assert obj.shape is None
+    assert obj.length() == MAX_SHAPE_KEYS + 1
+    assert obj.getfield('k3').int_val == 3
+    assert obj.getfield('missing') is None
+    assert obj.object_val['k%d' % MAX_SHAPE_KEYS].int_val == MAX_SHAPE_KEYS
+
+def test_object_field_cache(engine):
+    code = compile_source("""
+        a: value {"k": 1, "j": 2}
+        b: value {"j": 3}
+        value [a["j"], b["j"]]
+    """)
+    val = eval_code(engine, code)
+    assert [el.int_val for el in val.array_val] == [2, 3]
+    assert len(code.index_caches) == 2
+    assert code.index_caches[0].index == 1
+    assert code.index_caches[1].index == 0
+    with pytest.raises(KeyError):
+        eval_source_code(Engine('hoe'), 'a: value {"k": 1}\nvalue a["j"]')
+
+def test_str_rope(engine):
+    from hoe.runtime import concat
+    val = eval_source_code(engine, """
+        s: value ""
+        i: iter 1000
+            s: eval "+" [s, "chunk-"]
+        end
+        value s
+    """)
+    assert not val.is_flat()
+    assert val.length() == 6000
+    assert val.str_val == 'chunk-' * 1000
+    assert val.is_flat()
+    short = concat(Str("a"), Str("b"))
+    assert short.is_flat() and short.str_val == "ab"
+    assert concat(Str(""), val) is val
+
+def test_str_rope_observed(engine):
+    val = eval_source_code(engine, """
+        s: value ""
+        i: iter 30
+            s: eval "+" [s, "abc"]
+        end
+        t: eval "+" [s, ""]
+        size: eval "len" s
+        same: eval "=" [s, t]
+        different: eval "=" [s, "abc"]
+        value [size, same, different, s]
+    """)
+    size, same, different, s = val.array_val
+    assert size.int_val == 90
+    assert same is true
+    assert different is false
+    assert s.str_val == 'abc' * 30
+
+def test_range(engine):
+    from hoe.runtime import Range
+    val = eval_source_code(engine, """
+        r: eval "range" [2, 10, 3]
+        size: eval "len" r
+        empty: eval "range" [5, 0]
+        empty_size: eval "len" empty
+        down: eval "range" [5, 0, -2]
+        sum: value 0
+        x: iter r
+            sum: eval "+" [sum, x]
+        end
+        value [r, size, empty_size, down, sum]
+    """)
+    r, size, empty_size, down, sum = val.array_val
+    assert isinstance(r, Range)
+    assert r.__str__() == '[2, 5, 8]'
+    assert size.int_val == 3
+    assert empty_size.int_val == 0
+    assert down.__str__() == '[5, 3, 1]'
+    assert sum.int_val == 15
+
+def test_lazy_map_filter(engine):
+    val = eval_source_code(engine, """
+        proc "big" eval "=" [$, 400] end
+        proc "square" eval "*" [$, $] end
+        numbers: eval "range" 100000000
+        squares: eval "map" ["square", numbers]
+        found: eval "filter" ["big", squares]
+        has_big: eval "any" found
+        size: eval "len" squares
+        kind: eval "type" found
+        small: eval "range" 5
+        small_squares: eval "map" ["square", small]
+        total: value 0
+        x: iter small_squares
+            total: eval "+" [total, x]
+        end
+        value [has_big, size, kind, total]
+    """)
+    has_big, size, kind, total = val.array_val
+    assert has_big is true
+    assert size.int_val == 100000000
+    assert kind.str_val == 'seq'
+    assert total.int_val == 30
+
+def test_array_materializes_seq(engine):
+    val = eval_source_code(engine, """
+        proc "double" eval "*" [$, 2] end
+        r: eval "range" 4
+        items: eval "array" r
+        lazy: eval "map" ["double", r]
+        doubled: eval "array" lazy
+        value [items, doubled]
+    """)
+    items, doubled = val.array_val
+    assert isinstance(items, Array)
+    assert items.__str__() == '[0, 1, 2, 3]'
+    assert doubled.__str__() == '[0, 2, 4, 6]'
+
+def test_lazy_callbacks_outlive_their_scope(engine, tmpdir):
+    val = eval_source_code(engine, """
+        proc "squares"
+            proc "square" eval "*" [$, $] end
+            proc "odd?" eval "=" [$, 1] end
+            r: eval "range" $
+            s: eval "map" ["square", r]
+            eval "filter" ["odd?", s]
+        end
+        odd: eval "squares" 3
+        r: eval "range" 2
+        strs: eval "map" ["str", r]
+        value [odd, strs]
+    """)
+    assert val.__str__() == '[[1], ["0", "1"]]'
+    with pytest.raises(Exception) as e:
+        eval_source_code(engine, 'r: eval "range" 2\neval "map" ["missing", r]')
+    assert 'missing' in str(e.value)
+    tmpdir.join('lines.txt').write('a\nb\n')
+    with pytest.raises(Exception) as e:
+        eval_source_code(engine, """
+            f: eval "io.open" "%s"
+            eval "len" f
+        """ % tmpdir.join('lines.txt'))
+    assert 'no length' in str(e.value)
+    f = engine.files[-1]
+    assert f.readline() == 'a\n'
+
+def test_io_files(engine, tmpdir):
+    path = str(tmpdir.join('out.txt'))
+    eval_source_code(engine, """
+        out: eval "io.open" ["%s", "w"]
+        eval "io.write" [out, "first"]
+        eval "io.write" [out, "-line"]
+        eval "io.close" out
+    """ % path)
+    assert tmpdir.join('out.txt').read() == 'first-line'
+    tmpdir.join('out.txt').write('first\nsecond\nthird')
+    val = eval_source_code(engine, """
+        in: eval "io.open" "%s"
+        head: eval "io.read" [in, 3]
+        rest: eval "io.readline" in
+        lines: value 0
+        line: iter in
+            lines: eval "+" [lines, 1]
+        end
+        eof: eval "io.readline" in
+        eval "io.close" in
+        value [head, rest, lines, eof]
+    """ % path)
+    head, rest, lines, eof = val.array_val
+    assert head.str_val == 'fir'
+    assert rest.str_val == 'st\n'
+    assert lines.int_val == 2
+    assert eof.str_val == ''
+
+def test_io_buffered_lines(tmpdir, monkeypatch):
+    from hoe import fileio
+    monkeypatch.setattr(fileio, 'BUFFER_SIZE', 100)
+    path = str(tmpdir.join('big.txt'))
+    tmpdir.join('big.txt').write(''.join('line %d\n' % i for i in range(2000)))
+    for mode in ['r', 'm']:
+        f = fileio.open_file(path, mode)
+        lines = []
+        cursor = f.cursor()
+        line = cursor.next()
+        while line is not None:
+            lines.append(line.str_val)
+            line = cursor.next()
+        f.close()
+        assert len(lines) == 2000
+        assert lines[1234] == 'line 1234\n'
+    f = fileio.open_file(path, 'm')
+    assert f.read(7) == 'line 0\n'
+    f.close()
+    with pytest.raises(Exception):
+        f.readline()
+
+def test_io_package(pkg_engine, tmpdir):
+    import os, shutil
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    shutil.copy(os.path.join(root, 'pkg', 'io.ho'), str(tmpdir.join('pkg', 'io.ho')))
+    path = str(tmpdir.join('data.txt'))
+    val = eval_source_code(pkg_engine, """
+        eval "import" "io"
+        eval "write_file" ["%s", "hello"]
+        eval "read_file" "%s"
+    """ % (path, path))
+    assert val.str_val == 'hello'
+
+def test_io_puts_buffered(engine, capfd):
+    val = eval_source_code(engine, """
+        s: value ""
+        i: iter 10
+            s: eval "+" [s, "0123456789"]
+        end
+        r: eval "range" 3
+        eval "io.puts" [1, 2.5, s, {"k": null}, r]
+    """)
+    assert capfd.readouterr()[0] == ''
+    eval_source_code(engine, 'eval "io.flush"')
+    expected = '[1, 2.500000, "%s", {k: null}, [0, 1, 2]]\n' % ('0123456789' * 10)
+    assert capfd.readouterr()[0] == expected
+    assert not engine.stdout.pending
+
+def test_io_puts_line_buffered(engine, capfd):
+    engine.stdout.line_buffered = True
+    eval_source_code(engine, 'eval "io.puts" "hi"')
+    assert capfd.readouterr()[0] == '"hi"\n'
+
+def test_run_script_flushes(tmpdir, capfd):
+    script = tmpdir.join('script.ho')
+    script.write('eval "io.puts" 1\neval "nope" 2\n')
+    engine = Engine('hoe')
+    assert engine.run_script(str(script)) == 1
+    out = capfd.readouterr()[0]
+    assert out.startswith('1\n')
+    assert 'nope' in out
+
+def test_run_script_closes_files(tmpdir):
+    out = tmpdir.join('out.txt')
+    script = tmpdir.join('script.ho')
+    script.write('f: eval "io.open" ["%s", "w"]\neval "io.write" [f, "kept"]\n' % out)
+    assert Engine('hoe').run_script(str(script)) == 0
+    assert out.read() == 'kept'
+    script.write('f: eval "io.open" ["%s", "w"]\neval "io.write" [f, "kept"]\neval "nope" 1\n' % out)
+    engine = Engine('hoe')
+    assert engine.run_script(str(script)) == 1
+    assert out.read() == 'kept'
+    assert engine.files == []
+
+def test_socket_loopback(engine):
+    val = eval_source_code(engine, """
+        server: eval "socket._listen" ["127.0.0.1", 0]
+        port: eval "socket._port" server
+        client: eval "socket._connect" ["127.0.0.1", port]
+        conn: eval "socket._accept" server
+        sent: eval "socket._send" [client, "ping"]
+        data: eval "socket._recv" [conn, 4]
+        eval "socket._setblocking" [conn, false]
+        nothing: eval "socket._recv" [conn, 16]
+        eval "socket._close" client
+        eof: eval "socket._recv" [conn, 16]
+        eval "socket._close" conn
+        eval "socket._close" server
+        kind: eval "type" server
+        value [sent, data, nothing, eof, kind]
+    """)
+    sent, data, nothing, eof, kind = val.array_val
+    assert sent.int_val == 4
+    assert data.str_val == 'ping'
+    assert nothing is null
+    assert eof.str_val == ''
+    assert kind.str_val == 'socket'
+
+def test_epoll_wait_resumes_after_signals():
+    import os, signal, time
+    from hoe.lib.epoll import EPoll, EPOLLIN
+    read_fd, write_fd = os.pipe()
+    poll = EPoll()
+    poll.register(read_fd, EPOLLIN)
+    old = signal.signal(signal.SIGALRM, lambda signum, frame: None)
+    signal.setitimer(signal.ITIMER_REAL, 0.01, 0.01)
+    try:
+        start = time.time()
+        assert poll.wait(200, 8) == []
+        assert time.time() - start >= 0.15
+        os.write(write_fd, 'x')
+        assert poll.wait(-1, 8) == [(read_fd, EPOLLIN)]
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old)
+        poll.close()
+        os.close(read_fd)
+        os.close(write_fd)
+
+def test_socket_event_loop(engine):
+    clients = 50
+    val = eval_source_code(engine, """
+        proc "on_accept"
+            conn: eval "socket._accept" $
+            eval "socket._setblocking" [conn, false]
+            eval "socket._watch" [conn, "r", "on_echo"]
+        end
+        proc "on_echo"
+            data: eval "socket._recv" [$, 16]
+            cond
+                eval "=" [data, ""]
+                    eval "socket._close" $
+                value true
+                    eval "socket._send" [$, data]
+            end
+        end
+        proc "on_reply"
+            data: eval "socket._recv" [$, 16]
+            cond
+                eval "=" [data, "ping"]
+                    eval "socket._close" $
+            end
+        end
+        server: eval "socket._listen" ["127.0.0.1", 0]
+        eval "socket._setblocking" [server, false]
+        eval "socket._watch" [server, "r", "on_accept"]
+        port: eval "socket._port" server
+        i: iter %d
+            client: eval "socket._connect" ["127.0.0.1", port]
+            eval "socket._send" [client, "ping"]
+            eval "socket._watch" [client, "r", "on_reply"]
+        end
+        dispatched: eval "socket._loop" 200
+        eval "socket._close" server
+        value dispatched
+    """ % clients)
+    assert val.int_val == 4 * clients
+    assert engine.loop.watchers == {}
+    assert engine.loop.poll is None
+
+def count_epoll_fds():
+    import os
+    count = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            if 'eventpoll' in os.readlink('/proc/self/fd/' + fd):
+                count += 1
+        except OSError:
+            pass
+    return count
+
+def test_event_loop_releases_epoll_fd(tmpdir):
+    before = count_epoll_fds()
+    engine = Engine('hoe')
+    eval_source_code(engine, """
+        server: eval "socket._listen" ["127.0.0.1", 0]
+        eval "socket._watch" [server, "r", "on_accept"]
+        eval "socket._watch" [server, "rw", "on_accept"]
+        eval "socket._unwatch" server
+        eval "socket._watch" [server, "r", "on_accept"]
+        eval "socket._close" server
+    """)
+    assert count_epoll_fds() == before
+    script = tmpdir.join('script.ho')
+    script.write('server: eval "socket._listen" ["127.0.0.1", 0]\n'
+                 'eval "socket._watch" [server, "r", "on_accept"]\n')
+    engine = Engine('hoe')
+    assert engine.run_script(str(script)) == 0
+    assert engine.loop.watchers == {}
+    assert count_epoll_fds() == before
+
+def test_tasks_and_channels(engine):
+    val = eval_source_code(engine, """
+        proc "worker"
+            ch: value $[0]
+            name: value $[1]
+            i: iter 3
+                eval "chan.send" [ch, name]
+                eval "task.yield"
+            end
+        end
+        proc "square" eval "*" [$, $] end
+        proc "waiter" eval "task.join" $ end
+        ch: eval "chan.new"
+        eval "task.spawn" ["worker", [ch, "a"]]
+        eval "task.spawn" ["worker", [ch, "b"]]
+        log: value ""
+        i: iter 6
+            name: eval "chan.recv" ch
+            log: eval "+" [log, name]
+        end
+        square: eval "task.spawn" ["square", 7]
+        waiter: eval "task.spawn" ["waiter", square]
+        joined: eval "task.join" waiter
+        eval "task.run" null
+        kind: eval "type" waiter
+        value [log, joined, kind]
+    """)
+    log, joined, kind = val.array_val
+    assert log.str_val == 'ababab'
+    assert joined.int_val == 49
+    assert kind.str_val == 'task'
+    assert engine.scheduler.ready == []
+    assert engine.scheduler.current is None
+
+def test_buffered_channel(engine):
+    val = eval_source_code(engine, """
+        proc "producer"
+            i: iter 5
+                eval "chan.send" [$, i]
+            end
+        end
+        ch: eval "chan.new" 2
+        eval "task.spawn" ["producer", ch]
+        eval "task.run" null
+        first: eval "chan.recv" ch
+        eval "task.run" null
+        total: value first
+        i: iter 4
+            x: eval "chan.recv" ch
+            total: eval "+" [total, x]
+        end
+        value total
+    """)
+    assert val.int_val == 10
+
+def test_task_switch_errors(engine):
+    with pytest.raises(Exception) as e:
+        eval_source_code(Engine('hoe'), 'ch: eval "chan.new"\neval "chan.recv" ch')
+    assert 'deadlock' in str(e.value)
+    with pytest.raises(Exception) as e:
+        eval_source_code(Engine('hoe'), """
+            proc "pause" eval "task.yield" end
+            proc "bad" eval "map" ["pause", [1]] end
+            t: eval "task.spawn" "bad"
+            eval "task.join" t
+        """)
+    assert 'callback' in str(e.value)
+
+def test_pmap(engine):
+    val = eval_source_code(engine, """
+        proc "square" eval "*" [$, $] end
+        r: eval "range" 10
+        squares: eval "pmap" ["square", r, 3]
+        inline: eval "pmap" ["square", [1.5, 2], 1]
+        empty: eval "pmap" ["square", [], 4]
+        value [squares, inline, empty]
+    """)
+    squares, inline, empty = val.array_val
+    assert [x.int_val for x in squares.array_val] == [i * i for i in range(10)]
+    assert inline.__str__() == '[2.250000, 4]'
+    assert empty.length() == 0
+
+def test_pmap_values_and_errors(engine):
+    from hoe.pmap import encode_value, decode_value
+    value = eval_source_code(engine, """
+        value [1, -7, 2.5, -0.125, "s", "", null, true, {"k": [false]}, []]
+    """)
+    data = encode_value(value)
+    assert decode_value(data).__str__() == value.__str__()
+    assert encode_value(newint(-2)) == 'i' + '\xff' * 7 + '\xfe'
+    assert encode_value(Str('ab')) == 's\x00\x00\x00\x02ab'
+    assert encode_value(Array([null, true])) == 'a\x00\x00\x00\x02nt'
+    for i in range(len(data)):
+        with pytest.raises(ValueError):
+            decode_value(data[:i])
+    with pytest.raises(ValueError):
+        decode_value(data + 'n')
+    with pytest.raises(ValueError):
+        decode_value('x')
+    val = eval_source_code(engine, """
+        proc "wrap" value {"v": $} end
+        eval "pmap" ["wrap", ["a", "b", "c", "d"], 2]
+    """)
+    assert val.__str__() == '[{v: "a"}, {v: "b"}, {v: "c"}, {v: "d"}]'
+    with pytest.raises(Exception) as e:
+        eval_source_code(Engine('hoe'), """
+            proc "boom" eval "nope" $ end
+            eval "pmap" ["boom", [1, 2], 2]
+        """)
+    assert 'pmap failed' in str(e.value)
+
+def test_pmap_cleans_up_on_errors(engine, monkeypatch):
+    import errno, os
+    from hoe import pmap
+    def decode_value(data):
+        raise ValueError('corrupt')
+    monkeypatch.setattr(pmap, 'decode_value', decode_value)
+    jobs = []
+    start_worker = pmap.start_worker
+    def record_worker(engine, func_name, items):
+        jobs.append(start_worker(engine, func_name, items))
+        return jobs[-1]
+    monkeypatch.setattr(pmap, 'start_worker', record_worker)
+    fds = len(os.listdir('/proc/self/fd'))
+    with pytest.raises(ValueError):
+        eval_source_code(engine, """
+            proc "id" value $ end
+            eval "pmap" ["id", [1, 2, 3, 4], 4]
+        """)
+    assert len(os.listdir('/proc/self/fd')) == fds
+    assert len(jobs) == 4
+    for job in jobs:
+        with pytest.raises(OSError) as e:
+            os.waitpid(job.pid, os.WNOHANG)
+        assert e.value.errno == errno.ECHILD
+
+def test_profiler(engine):
+    assert engine.profiler is None
+    profiler = engine.start_profiling()
+    eval_source_code(engine, """
+        proc "count"
+            cond
+                eval "=" [$, 0]
+                    value 0
+                value true
+                    begin
+                        n: eval "-" [$, 1]
+                        eval "len" "ab"
+                        eval "count" n
+                    end
+            end
+        end
+        eval "count" 5
+    """)
+    assert engine.stop_profiling() is profiler
+    assert engine.profiler is None
+    entries = dict((e.name, e) for e in profiler.sorted_entries())
+    count, length = entries['count'], entries['len']
+    assert (count.kind, count.calls) == ('proc', 6)
+    assert (length.kind, length.calls) == ('builtin', 5)
+    assert 0.0 <= length.self_time <= length.cum_time
+    assert count.cum_time >= count.self_time
+    assert count.cum_time >= length.cum_time
+    assert not profiler.calls
+
+def test_profiler_counts_operators(engine):
+    profiler = engine.start_profiling()
+    val = eval_source_code(engine, """
+        proc "fib"
+            cond
+                eval "=" [$, 0]
+                    value 0
+                eval "=" [$, 1]
+                    value 1
+                value true
+                    begin
+                        a: eval "-" [$, 1]
+                        b: eval "fib" a
+                        c: eval "-" [$, 2]
+                        d: eval "fib" c
+                        eval "+" [b, d]
+                    end
+            end
+        end
+        eval "fib" 10
+    """)
+    engine.stop_profiling()
+    assert val.int_val == 55
+    entries = dict((e.name, e) for e in profiler.sorted_entries())
+    assert (entries['fib'].kind, entries['fib'].calls) == ('proc', 177)
+    assert (entries['+'].kind, entries['+'].calls) == ('builtin', 88)
+    assert entries['-'].calls == 176
+    assert entries['='].calls > 177
+
+def test_profiler_reports(tmpdir, capfd):
+    from targethoe import main
+    script = tmpdir.join('script.ho')
+    script.write('proc "f" eval "str" $ end\neval "f" 1\neval "f" 2\n')
+    assert main(['hoe', '--profile', str(script)]) == 0
+    err = capfd.readouterr()[1]
+    assert err.splitlines()[0].split() == ['calls', 'self(ms)', 'cum(ms)', 'kind', 'name']
+    rows = [line.split() for line in err.splitlines()[1:]]
+    assert [(row[0], row[3], row[4]) for row in rows] == [
+        ('2', 'proc', 'f'), ('2', 'builtin', 'str')]
+    report = json.loads(tmpdir.join('script.ho.profile.json').read())
+    calls = dict((item['name'], (item['kind'], item['calls'])) for item in report)
+    assert calls == {'f': ('proc', 2), 'str': ('builtin', 2)}
+    assert all(item['cum'] >= item['self'] >= 0 for item in report)
+
+def test_sampler(engine, monkeypatch):
+    from hoe import builtin
+    def builtin_sample(engine, payload):
+        # as if the timer fired during the call
+        engine.sampler.occurred.c_value = -1
+        return null
+    monkeypatch.setitem(builtin.BUILTINS, 'test.sample', builtin_sample)
+    assert engine.sampler is None
+    # the timer itself never fires within the test
+    sampler = engine.start_sampling(100000000)
+    try:
+        eval_source_code(engine, """
+            proc "spin"
+                r: eval "range" $
+                x: iter r
+                    n: eval "test.sample"
+                end
+            end
+            total: eval "spin" 3
+            eval "test.sample"
+        """)
+    finally:
+        assert engine.stop_sampling() is sampler
+    assert engine.sampler is None
+    assert sampler.samples == 4
+    assert sampler.report_collapsed() == 'main:total;spin:n 3\nmain 1\n'
+
+def test_sampler_tail_begin():
+    from hoe.sampler import frame_name
+    code = compile_source("""
+        proc "f"
+            begin
+                a: eval "len" $
+            end
+        end
+    """)
+    block = code.codes[0].codes[0]
+    assert frame_name(block, 0) == 'f.begin:a'
+
+def test_sampler_main(tmpdir):
+    from targethoe import main
+    script = tmpdir.join('script.ho')
+    script.write('proc "f"\nr: eval "range" $\nx: iter r\neval "str" x\nend\nend\neval "f" 2000\n')
+    assert main(['hoe', '--sample=100', str(script)]) == 0
+    for line in tmpdir.join('script.ho.folded').read().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert stack.startswith('main') and int(count) > 0
+    assert main(['hoe', '--sample=x', str(script)]) == 1
+
+PARSER_SOURCES = [
+    'a: value [1, -2.5e3, "s\\"q", true, false, null, $, $[0]["k"], x[1]]',
+    'b: value {} c: value {"a": 1, b: [ ], "c": {"d": null},}',
+    'value [1 2 3]\nvalue [1, 2 3]\nvalue {"a": 1 "b": 2}\nvalue 1e5\nvalue 0',
+    'eval "f"\neval "g" {"x": []}\nproc "p" end\nproc "q" value 1 b: value 2 end',
+    'begin end\nbegin value 1 end\ncond end\ncond value 1 value 2 end',
+    'x: iter [1] end\niter $ value 1 end\nvalues: value trueish',
+    '  # comment\n#\nvalue "multi\nline # not a comment"\n# end',
+    '# crlf\r\na: value 1\r\n  # comment\r\nb: value [a,\r\n 2]\r\n',
+    'a: value 1\rb: value 2\r# comment\rvalue b',
+    '\t# tab\n \t # mixed\nbegin\n\t\t# nested\n  value 1\nend\n\t#',
+]
+
+def tree_shape(node):
+    from rpython.rlib.parsing.tree import Symbol
+    if isinstance(node, Symbol):
+        return (node.symbol, node.additional_info)
+    return (node.symbol, [tree_shape(child) for child in node.children])
+
+def test_parser_matches_ebnf():
+    import glob, os
+    from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
+    from hoe.grammar import EBNF, parse_source
+    regexes, rules, to_ast = parse_ebnf(EBNF)
+    parse = make_parse_function(regexes, rules, eof=True)
+    to_ast = to_ast()
+    root = os.path.join(os.path.dirname(__file__), '..')
+    sources = list(PARSER_SOURCES)
+    for path in glob.glob(os.path.join(root, 'pkg', '*.ho')) + \
+            glob.glob(os.path.join(root, 'bench', '*.ho')):
+        with open(path) as f:
+            sources.append(f.read())
+    for source in sources:
+        lines = [l for l in source.splitlines() if not l.strip().startswith('#')]
+        expected = to_ast.transform(parse('\n'.join(lines)))
+        assert tree_shape(parse_source(source)) == tree_shape(expected)
+
+def test_parser_errors():
+    from hoe.grammar import parse_source, ParseError, LexerError
+    tree = parse_source('# c\n\na: value "x\ny"\n  b: value 1')
+    assert tree.children[1].children[0].token.source_pos.lineno == 4
+    assert tree.children[1].children[0].token.source_pos.columnno == 2
+    for source in ['', '# only a comment', 'eval "x"\na: value 1',
+                   'value 1\nvalue [1, 2 3, 4]', 'value [1 2, 3]',
+                   'a value 1', 'proc "p" value 1', 'cond a: value 1 end',
+                   'value {"a"}', 'value 1e', 'value 01']:
+        with pytest.raises(ParseError):
+            parse_source(source)
+    for source in ['value 1 # trailing', 'value 1.', 'value\t1', 'value "open',
+                   'value -x', '\tvalue 1', 'a: value 1\n\t b: value 2']:
+        with pytest.raises(LexerError):
+            parse_source(source)
+
+def test_import_skips_grammar_construction():
+    import os, subprocess, sys
+    src = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([src] + sys.path)
+    output = subprocess.check_output([sys.executable, '-c', (
+        'import sys, targethoe\n'
+        'print(sorted(m for m in sys.modules if m.startswith("rpython.rlib.parsing")))'
+    )], env=env, cwd=src)
+    assert b'ebnfparse' not in output
+    assert b'regexparse' not in output
+
+def test_script_exit_status(tmpdir):
+    import os, subprocess, sys
+    src = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([src] + sys.path)
+    script = tmpdir.join('failing.ho')
+    script.write('eval "nope" 1\n')
+    with open(os.devnull, 'w') as devnull:
+        status = subprocess.call([sys.executable, os.path.join(src, 'targethoe.py'),
+                                  str(script)], env=env, stdout=devnull)
+    assert status == 1